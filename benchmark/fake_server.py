@@ -0,0 +1,142 @@
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from metrics import get_endpoint
+
+
+# in-process stand-in for Jellyfin (with the Playback Reporting plugin) and Jellystat
+class FakeJellyfin:
+    def __init__(self, users=20, folders=5, plays_per_user=30, latency_sec=0.0, seed=1):
+        self.latency_sec = latency_sec
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        rnd = random.Random(seed)
+        self.users = {f'{i:032x}': f'user{i}' for i in range(1, users + 1)}
+        self.folders = [f'{0xf000 + i:032x}' for i in range(folders)]
+        self.policies = {user_id: {'IsDisabled': False, 'EnabledFolders': list(self.folders)}
+                         for user_id in self.users}
+        self.sessions = []
+        self.failing = set()  # endpoints answering with 500, e.g. 'POST /user_usage_stats/submit_custom_query'
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.execute('CREATE TABLE PlaybackActivity (DateCreated TEXT, UserId TEXT, ItemId TEXT, PlayDuration INT)')
+        start = datetime.now().replace(hour=0, minute=0, second=1)
+        rows = []
+        for user_id in self.users:
+            for _ in range(plays_per_user):
+                date = start - timedelta(days=rnd.randint(0, 2), seconds=rnd.randint(0, 3600))
+                rows.append((date.strftime('%Y-%m-%d %H:%M:%S.%f'), user_id, 'item', rnd.randint(60, 1200)))
+        self.db.executemany('INSERT INTO PlaybackActivity VALUES (?, ?, ?, ?)', rows)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests.clear()
+
+    def total_requests(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def play(self, user_id, duration_sec):
+        with self.lock:
+            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+            self.db.execute('INSERT INTO PlaybackActivity VALUES (?, ?, ?, ?)', (now, user_id, 'item', duration_sec))
+
+    def query(self, sql):
+        with self.lock:
+            return [list(x) for x in self.db.execute(sql)]
+
+    def handle(self, method, path, body):
+        route = path.split('?')[0]
+        endpoint = f'{method} {get_endpoint(route)}'
+        with self.lock:
+            self.requests[endpoint] += 1
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+        if endpoint in self.failing:
+            return 500, None
+        if method == 'GET' and route == '/Users':
+            return 200, [{'Id': k, 'Name': v} for k, v in self.users.items()]
+        if method == 'GET' and route == '/Sessions':
+            return 200, self.sessions
+        match = re.fullmatch(r'/Users/(\w+)(/Policy)?', route)
+        if match and match.group(1) in self.users:
+            user_id = match.group(1)
+            if method == 'GET' and not match.group(2):
+                return 200, {'Id': user_id, 'Name': self.users[user_id], 'Policy': self.policies[user_id]}
+            if method == 'POST' and match.group(2):
+                self.policies[user_id] = json.loads(body)
+                return 204, None
+        if method == 'POST' and route == '/user_usage_stats/submit_custom_query':
+            return 200, {'results': self.query(json.loads(body)['CustomQueryString'])}
+        if method == 'POST' and route == '/stats/getGlobalUserStats':
+            user_id = json.loads(body)['userid']
+            today = datetime.now().strftime('%Y-%m-%d')
+            total = self.query(f"SELECT SUM(PlayDuration) FROM PlaybackActivity"
+                               f" WHERE UserId='{user_id}' AND DateCreated > '{today}'")[0][0]
+            return 200, {'total_playback_duration': total or 0}
+        if method == 'GET' and route == '/api/getHistory':
+            return 200, self.get_history({k: v[0] for k, v in parse_qs(urlsplit(path).query).items()})
+        return 404, None
+
+    def get_history(self, query):
+        size = int(query.get('size', 50))
+        page = int(query.get('page', 1))
+        count = self.query('SELECT COUNT(*) FROM PlaybackActivity')[0][0]
+        rows = self.query(f'SELECT rowid, UserId, DateCreated, PlayDuration FROM PlaybackActivity'
+                          f' ORDER BY DateCreated DESC LIMIT {size} OFFSET {(page - 1) * size}')
+        results = [{'Id': str(rowid), 'UserId': user_id, 'PlaybackDuration': duration,
+                    'ActivityDateInserted': datetime.fromisoformat(date).astimezone(timezone.utc).isoformat()}
+                   for rowid, user_id, date, duration in rows]
+        return {'current_page': page, 'pages': -(-count // size), 'size': size, 'results': results}
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, as served by Jellyfin
+            wbufsize = -1  # headers and body leave in one segment, no delayed ACK stalls
+
+            def respond(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, payload = fake.handle(method, self.path, body)
+                data = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
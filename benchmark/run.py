@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+from benchmark.fake_server import FakeJellyfin
+from config import Configuration
+from jellyfin.async_interact import AsyncServerInteraction
+from jellyfin.interact import ServerInteraction
+from jellyfin.state import StateSnapshot
+from jellyfin.triggers import TriggerQueue
+from misc import setup_language
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of JellyWatchWise against a fake Jellyfin server')
+    parser.add_argument('--users', type=int, default=20, help='number of simulated users')
+    parser.add_argument('--latency-ms', type=float, default=5, help='latency added to every fake server response')
+    parser.add_argument('--cycles', type=int, default=5, help='number of measured poll cycles')
+    parser.add_argument('--views', type=int, default=50, help='number of simulated connected dashboards')
+    parser.add_argument('--burst', type=int, default=50, help='number of webhook triggers sent in a burst')
+    parser.add_argument('--stats', choices=['playback', 'jellystat', 'jellystat-mirror'], default='playback',
+                        help='stats backend')
+    parser.add_argument('--concurrency', type=int, default=4)
+    return parser.parse_args()
+
+
+def write_config(fake, args):
+    config = {
+        'server': {'host': fake.url, 'token': 'benchmark'},
+        'limits': {'default_limit': 60},
+        'http': {'retries': 0, 'concurrency': args.concurrency},
+        'general': {'log_level': 'warning'},
+    }
+    if args.stats.startswith('jellystat'):
+        config['stats'] = {'host': fake.url, 'token': 'benchmark', 'mirror': args.stats == 'jellystat-mirror'}
+    os.makedirs('config', exist_ok=True)
+    with open('config/config.yaml', 'w') as file:
+        yaml.dump(config, file)
+
+
+class Report:
+    def __init__(self, fake):
+        self.fake = fake
+        self.rows = []
+
+    async def measure(self, name, coroutine, repeat=1):
+        self.fake.reset_counters()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await coroutine()
+        wall = (time.perf_counter() - start) / repeat
+        requests = self.fake.total_requests() / repeat
+        endpoints = ', '.join(f'{k}: {v / repeat:g}' for k, v in self.fake.requests.most_common())
+        self.rows.append((name, wall, requests, endpoints))
+
+    def print(self):
+        print(f'{"scenario":<28} {"wall ms":>9} {"requests":>9}  endpoints')
+        for name, wall, requests, endpoints in self.rows:
+            print(f'{name:<28} {wall * 1000:>9.1f} {requests:>9g}  {endpoints}')
+
+
+async def run(args, fake):
+    report = Report(fake)
+    config = Configuration(['config/config.yaml'])
+    holder = {}
+
+    async def startup():
+        holder['interact'] = await asyncio.to_thread(ServerInteraction, config, StateSnapshot())
+    await report.measure('startup (no snapshot)', startup)
+    await report.measure('startup (from snapshot)', startup)
+    interact = holder['interact']
+    engine = AsyncServerInteraction(interact, config.concurrency, config.slow_cycle_sec, config.poll_budget_sec)
+
+    await report.measure('poll cycle', engine.poll_users, args.cycles)
+
+    user_ids = list(interact.select_users)
+    for i in range(args.views):
+        view = {'user_id': None}
+        await engine.subscribe(i, random.choice(user_ids),
+                               lambda state, v=view: interact.fill_view(v, state['user_id'], state))
+    await report.measure(f'poll cycle, {args.views} views', engine.poll_users, args.cycles)
+
+    async def burst():
+        queue = TriggerQueue(engine.poll_users, engine.poll_users, config.trigger_window_sec / 10)
+        jobs = [queue.submit(random.choice(user_ids)) for _ in range(args.burst)]
+        while any(job['status'] in ('queued', 'running') for job in jobs):
+            await asyncio.sleep(0.01)
+    await report.measure(f'burst of {args.burst} triggers', burst)
+
+    fake.play(user_ids[0], 3600 * 5)  # exceeds the limit, the user gets locked
+    await report.measure('poll cycle with a lock', engine.poll_users)
+
+    # the circuit opens after a few failures
+    fake.failing.update(('POST /user_usage_stats/submit_custom_query', 'GET /api/getHistory',
+                         'POST /stats/getGlobalUserStats'))
+    await report.measure('poll cycle, stats down', engine.poll_users, args.cycles)
+    report.print()
+
+
+def main():
+    args = parse_args()
+    setup_language('en', os.path.join(REPO_DIR, 'lang'))
+    fake = FakeJellyfin(users=args.users, latency_sec=args.latency_ms / 1000).start()
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            write_config(fake, args)
+            asyncio.run(run(args, fake))
+            os.chdir(REPO_DIR)
+    finally:
+        fake.stop()
+    _, peak = tracemalloc.get_traced_memory()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'python heap peak: {peak / 2 ** 20:.1f} MiB, max RSS: {max_rss / 2 ** 10:.1f} MiB'
+          f' (includes the fake server)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
+import atexit
+import copy
+import json
 import logging
+import queue
 from datetime import datetime
-from os.path import isfile
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from os.path import getmtime, isfile
 
 import yaml
 
@@ -15,60 +20,173 @@ LOG_LEVELS = {
 }
 
 
-def setup_logging(log_level=logging.INFO):
+# standard attributes of a log record, the others come from `extra` and are written as JSON fields
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+log_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'message': record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_file_handler(file_name, max_bytes, backup_count, rotate_when):
+    if rotate_when:
+        return TimedRotatingFileHandler(file_name, when=rotate_when, backupCount=backup_count)
+    return RotatingFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count)
+
+
+# the stock handler formats on the calling thread and folds the traceback into the message;
+# here only the message is resolved, formatting (exception included) is left to the listener thread
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def stop_listener(listener):
+    # drains the records still queued and closes the files
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def stop_logging():
+    if log_listener:
+        stop_listener(log_listener)
+
+
+atexit.register(stop_logging)
+
+
+def setup_logging(log_level=logging.INFO, file_name='config/watchwise.log', max_bytes=10 * 2 ** 20, backup_count=5,
+                  rotate_when=None, json_format=False):
+    # records are only queued by the caller, a background thread formats them and writes to the console and file
+    global log_listener
     logger.setLevel(log_level)
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(logging.Formatter('[%(levelname)7s] %(message)s'))
-    file_handler = logging.FileHandler('config/watchwise.log')
-    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    file_handler = get_file_handler(file_name, max_bytes, backup_count, rotate_when)
+    if json_format:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    log_queue = queue.SimpleQueue()
+    previous_listener = log_listener
+    log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    log_listener.start()
     logger.propagate = False
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    logger.handlers.clear()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    if previous_listener:
+        stop_listener(previous_listener)  # after the swap, records queued meanwhile are still written
+
+
+WEEKDAYS = 7
+
+# settings used to build the server connection and the web app, a change needs a restart
+RESTART_KEYS = {
+    'server': ['host', 'token', 'policy_cache_ttl'],
+    'stats': None,
+    'http': None,
+    'limits': ['predictive_polling', 'polling_interval', 'live_playback'],
+    'view': ['language'],
+    'general': ['headless', 'port', 'log_level', 'log_format', 'log_max_mb', 'log_backup_count', 'log_rotate_when'],
+    'state': None,
+}
 
 
 def validate_limit_values(user_id, values):
     if isinstance(values, int):
-        return
+        return True
     if isinstance(values, list) and len(values) == 2:
-        return
-    if isinstance(values, list) and len(values) == 7:
-        return
+        return True
+    if isinstance(values, list) and len(values) == WEEKDAYS:
+        return True
     logger.warning(f'Improper limit for {user_id}: type {type(values)}')
+    return False
 
 
-def get_limit(values):
+def get_limit_table(values):
     if isinstance(values, int):
-        return values
+        return (values,) * WEEKDAYS
     if isinstance(values, list):
-        weekday = datetime.today().weekday()
         if len(values) == 2:
-            return values[0] if weekday < 5 else values[1]
-        if len(values) == 7:
-            return values[weekday]
-    return None
+            return (values[0],) * 5 + (values[1],) * 2
+        if len(values) == WEEKDAYS:
+            return tuple(values)
+    return (None,) * WEEKDAYS
+
+
+# keys of a `servers` entry taken into the `server` section, other sections of an entry override the shared ones
+SERVER_KEYS = ('host', 'token', 'policy_cache_ttl')
+SERVER_SECTIONS = ('limits', 'stats', 'http')
+
+
+def get_server_config(config, entry):
+    server_config = {k: v for k, v in config.items() if k != 'servers'}
+    server_config['server'] = {**(config.get('server') or {}), **{k: v for k, v in entry.items() if k in SERVER_KEYS}}
+    for section in SERVER_SECTIONS:
+        if isinstance(entry.get(section), dict):
+            server_config[section] = {**(config.get(section) or {}), **entry[section]}
+    return server_config
+
+
+def get_restart_keys(old_config, new_config):
+    changed = []
+    for section, keys in RESTART_KEYS.items():
+        old_values = old_config.get(section) or {}
+        new_values = new_config.get(section) or {}
+        for key in sorted(old_values.keys() | new_values.keys()):
+            if (keys is None or key in keys) and old_values.get(key) != new_values.get(key):
+                changed.append(f'{section}.{key}')
+    return changed
 
 
 class Configuration:
-    def __init__(self, config_files=['config.yaml', 'config/config.yaml', '/config/config.yaml']):
-        self.config = None
-        for config_file in config_files:
+    def __init__(self, config_files=['config.yaml', 'config/config.yaml', '/config/config.yaml'], reload=False,
+                 config=None, name=None):
+        self.config = config
+        self.file_name = None
+        self.name = name  # of the server, when several servers are configured
+        for config_file in config_files if config is None else []:
             if isfile(config_file):
                 with open(config_file, 'r') as file:
                     self.config = yaml.safe_load(file)
+                    self.file_name = config_file
                     self.log_level = self.get_key('general', 'log_level', 'info')
-                    setup_logging(LOG_LEVELS[self.log_level])
+                    if not reload:
+                        self.start_logging()
                     logger.info(f'Configuration read from: {config_file}')
         if self.config is None:
             raise FileNotFoundError(", ".join(config_files) + " - not found")
 
         self.host = self.get_key('server', 'host', None)
         self.token = self.get_key('server', 'token', None)
+        self.policy_cache_ttl = self.get_key('server', 'policy_cache_ttl', 60)
 
         self.default_limit = self.get_key('limits', 'default_limit', 60)
         self.user_limits = self.get_key('limits', 'user_limits', {})
         self.no_limit_users = self.get_key('limits', 'no_limit_users', [])
         self.no_limit_folders = self.get_key('limits', 'no_limit_folders', [])
         self.polling_interval = self.get_key('limits', 'polling_interval', 0)
+        self.predictive_polling = self.get_key('limits', 'predictive_polling', False)
+        self.session_check_interval = self.get_key('limits', 'session_check_interval', 0.5)
+        self.active_check_interval = self.get_key('limits', 'active_check_interval', 1)
+        self.idle_check_interval = self.get_key('limits', 'idle_check_interval', 15)
+        self.live_playback = self.get_key('limits', 'live_playback', True)
+        self.stop_playback_on_lock = self.get_key('limits', 'stop_playback_on_lock', False)
         self.account_enable_on_day_reset = self.get_key('limits', 'account_enable_on_day_reset', False)
 
         self.default_user = self.get_key('view', 'default_user', None)
@@ -76,11 +194,64 @@ class Configuration:
 
         self.stats_host = self.get_key('stats', 'host', None)
         self.stats_token = self.get_key('stats', 'token', None)
+        self.stats_incremental = self.get_key('stats', 'incremental', True)
+        self.stats_settle_hours = self.get_key('stats', 'settle_hours', 6)
+        self.stats_mirror = self.get_key('stats', 'mirror', False)
+
+        self.http_timeout = self.get_key('http', 'timeout', 10)
+        self.http_connect_timeout = self.get_key('http', 'connect_timeout', 5)
+        self.http_stats_timeout = self.get_key('http', 'stats_timeout', 30)
+        self.http_retries = self.get_key('http', 'retries', 2)
+        self.http_retry_backoff = self.get_key('http', 'retry_backoff', 0.5)
+        self.http_max_connections_per_host = self.get_key('http', 'max_connections_per_host', 4)
+        self.concurrency = self.get_key('http', 'concurrency', 4)
+        self.http_breaker_failures = self.get_key('http', 'breaker_failures', 3)
+        self.http_breaker_reset_sec = self.get_key('http', 'breaker_reset_sec', 30)
+        self.http_breaker_max_reset_sec = self.get_key('http', 'breaker_max_reset_sec', 300)
+
+        self.headless = self.get_key('general', 'headless', False)
+        self.port = self.get_key('general', 'port', 8080)
+        self.trigger_window_sec = self.get_key('general', 'trigger_window_sec', 2)
+        self.slow_cycle_sec = self.get_key('general', 'slow_cycle_sec', 10)
+        self.poll_budget_sec = self.get_key('general', 'poll_budget_sec', 30)
+        self.config_check_interval = self.get_key('general', 'config_check_interval', 5)
+
+        self.state_backend = self.get_key('state', 'backend', 'memory')
+        self.state_db = self.get_key('state', 'file', 'config/shared-state.db')
+        self.lease_sec = self.get_key('state', 'lease_sec', 30)
 
         self.limit_clients = self.get_key('access', 'limit_clients', False)
         self.accepted_clients = self.get_key('access', 'accepted_clients', ["127.0.0.", "192.168.", "10."])
 
-        self.validate_limits()
+        self.state_file = f'config/state-{name}.json' if name else 'config/state.json'
+        self.stats_db = f'config/jellystat-{name}.db' if name else 'config/jellystat.db'
+        self.servers = self.get_server_configs()
+
+        self.limits_valid = self.validate_limits() and all(x.limits_valid for x in self.servers if x is not self)
+        self.default_limit_table = get_limit_table(self.default_limit)
+        self.limit_tables = {user_id: tuple(x if x else default for x, default in
+                                            zip(get_limit_table(values), self.default_limit_table))
+                             for user_id, values in self.user_limits.items()}
+
+    def start_logging(self):
+        max_bytes = self.get_key('general', 'log_max_mb', 10) * 2 ** 20
+        backup_count = self.get_key('general', 'log_backup_count', 5)
+        rotate_when = self.get_key('general', 'log_rotate_when', None)
+        json_format = self.get_key('general', 'log_format', 'text') == 'json'
+        setup_logging(LOG_LEVELS[self.log_level], max_bytes=max_bytes, backup_count=backup_count,
+                      rotate_when=rotate_when, json_format=json_format)
+
+    def get_server_configs(self):
+        entries = self.config.get('servers')
+        if not entries:
+            return [self]
+        servers = []
+        for i, entry in enumerate(entries):
+            name = str(entry.get('name') or f'server{i + 1}')
+            if any(x.name == name for x in servers):
+                raise ValueError(f'server name {name} is used more than once')
+            servers.append(Configuration(config=get_server_config(self.config, entry), name=name))
+        return servers
 
     def get_key(self, primary_key, secondary_key, default_value):
         if primary_key in self.config:
@@ -97,7 +268,7 @@ class Configuration:
 
     def fix_default_user(self, select_users):
         if not self.default_user:
-            self.default_user = next(iter(select_users))
+            self.default_user = next(iter(select_users), None)
 
     def get_select_users(self, users):
         select_users = {k: v for k, v in users.items() if k not in self.no_limit_users}
@@ -113,13 +284,39 @@ class Configuration:
         return False
 
     def validate_limits(self):
-        validate_limit_values("default", self.default_limit)
+        valid = validate_limit_values("default", self.default_limit)
         for user_id, values in self.user_limits.items():
-            validate_limit_values(user_id, values)
+            valid = validate_limit_values(user_id, values) and valid
+        return valid
 
     def get_limit(self, user_id):
-        default_limit = get_limit(self.default_limit)
-        user_limit = None
-        if user_id in self.user_limits:
-            user_limit = get_limit(self.user_limits[user_id])
-        return user_limit if user_limit else default_limit
+        table = self.limit_tables.get(user_id, self.default_limit_table)
+        return table[datetime.today().weekday()]
+
+    def get_mtime(self):
+        try:
+            return getmtime(self.file_name)
+        except OSError:
+            return None
+
+    def reload(self):
+        try:
+            config = Configuration([self.file_name], reload=True)
+        except (OSError, yaml.YAMLError, TypeError, AttributeError, ValueError) as e:
+            logger.error(f'Configuration not reloaded: {e!r}')
+            return None
+        if not config.limits_valid:
+            logger.error(f'Configuration not reloaded, improper limits in {self.file_name}')
+            return None
+        changed = get_restart_keys(self.config, config.config)
+        old_servers = {x.name: x for x in self.servers}
+        new_servers = {x.name: x for x in config.servers}
+        if old_servers.keys() != new_servers.keys():
+            changed.append('servers')
+        else:
+            changed += [f'{name}: {x}' for name, server in new_servers.items() if name
+                        for x in get_restart_keys(old_servers[name].config, server.config)
+                        if x.split('.')[0] in ('server',) + SERVER_SECTIONS]
+        if changed:
+            logger.warning(f'Restart needed to apply: {", ".join(changed)}')
+        return config
@@ -0,0 +1,177 @@
+from datetime import datetime
+
+import i18n
+from nicegui import app, ui
+from nicegui.events import ValueChangeEventArguments
+
+from config import logger
+from service import WatchWiseService
+
+
+def get_event_text(event):
+    texts = {'limit': lambda: i18n.t('event_limit', t=event['value']), 'lock': lambda: i18n.t('event_lock'),
+             'unlock': lambda: i18n.t('event_unlock'), 'disabled': lambda: i18n.t('locked'),
+             'enabled': lambda: i18n.t('unlocked')}
+    text = texts[event['kind']]() if event['kind'] in texts else event['kind']
+    return f'{datetime.fromtimestamp(event["time"]):%Y-%m-%d %H:%M}  {text}'
+
+
+def run(service: WatchWiseService):
+    service.register_routes(app)
+    for task in service.get_startup_tasks():
+        app.on_startup(task)
+
+    @ui.page('/', title='JellyWatchWise')
+    async def index():
+        view = {
+            'user_id': None,
+            'user_link': None,
+            'folders': None,
+            'time_left': 0,
+            'time_watched_msg': None,
+            'time_left_msg': None,
+            'default_limit_msg': None,
+            'altered_limit_msg': None,
+            'active_msg': None,
+            'progress': 0,
+        }
+        link = None
+        chart = None
+        history = {'rollup': 'day', 'shown': False, 'events': ''}
+
+        def show_state(state):
+            service.get_worker(state['user_id']).interact.fill_view(view, state['user_id'], state)
+
+        class TimeLeftLabel(ui.label):
+            def _handle_text_change(self, text: str) -> None:
+                super()._handle_text_change(text)
+                if view['time_left'] > 0:
+                    self.classes(replace='text-positive')
+                else:
+                    self.classes(replace='text-negative')
+
+        async def show_history():
+            if chart is None or not history['shown']:
+                return
+            worker = service.get_worker(view['user_id'])
+            series = await worker.engine.get_history(view['user_id'], history['rollup'])
+            chart.options['xAxis']['data'] = [x['period'] for x in series]
+            chart.options['series'][0]['data'] = [x['watched'] for x in series]
+            chart.options['series'][1]['data'] = [x['limit'] for x in series]
+            chart.options['series'][2]['data'] = [x['locks'] for x in series]
+            chart.update()
+            events = await worker.engine.get_events(view['user_id'])
+            history['events'] = '\n'.join(get_event_text(x) for x in events)
+
+        async def toggle_history(event: ValueChangeEventArguments):
+            history['shown'] = event.value
+            await show_history()
+
+        async def change_rollup(event: ValueChangeEventArguments):
+            history['rollup'] = event.value
+            await show_history()
+
+        async def change_user(event: ValueChangeEventArguments):
+            user_id = event.value
+            username = service.get_select_users()[user_id]
+            ui.notify(i18n.t('selected', u=username))
+            await service.subscribe(ui.context.client.id, user_id, show_state)
+            link.props(f'href="{view["user_link"]}"')  # no official support to bind target
+            await show_history()
+
+        async def change_limit(diff):
+            if diff != 0:
+                msg = i18n.t('add', t=diff) if diff > 0 else i18n.t('sub', t=-diff)
+                ui.notify(msg)
+            user_id = view['user_id']
+            worker = service.get_worker(user_id)
+            logger.info(f'user {user_id} limit change: {diff}')
+            await worker.engine.alter_limit(user_id, diff)
+            await worker.refresh_user(user_id)
+            await show_history()
+
+        async def disable_user(lock: bool):
+            user_id = view['user_id']
+            worker = service.get_worker(user_id)
+            logger.info(f'user {user_id} is disabled: {lock}')
+            ui.notify(i18n.t('locked') if lock else i18n.t('unlocked'))
+            await worker.engine.disable_user(user_id, lock)
+            await worker.refresh_user(user_id)
+            await show_history()
+
+        async def on_connect():
+            logger.debug(f'client connected: ID {ui.context.client.id}')
+            await service.subscribe(ui.context.client.id, service.default_user, show_state)
+
+        def on_disconnect():
+            logger.debug(f'client disconnected: ID {ui.context.client.id}')
+            service.unsubscribe(ui.context.client.id)
+
+        ui.context.client.on_connect(lambda: on_connect())
+        ui.context.client.on_disconnect(lambda: on_disconnect())
+
+        try:
+            await ui.context.client.connected()
+            ip = ui.context.client.environ['asgi.scope']['client'][0]
+
+            if not service.config.is_access_granted(ip):
+                ui.label(i18n.t('restricted', ip=ip))
+            else:
+                with ui.row():
+                    with ui.column():
+                        with ui.button_group():
+                            props = "outlined dropdown-icon='img:https://cdn.quasar.dev/logo-v2/svg/logo.svg'" \
+                                    " prefix=' '"
+                            ui.select(service.get_select_users(), value=service.default_user,
+                                      on_change=change_user).props(props)
+
+                    with ui.card():
+                        ui.label().bind_text_from(view, 'time_watched_msg')
+                        ui.linear_progress(show_value=False).bind_value_from(view, 'progress').props('color=purple')
+                        TimeLeftLabel().bind_text_from(view, 'time_left_msg')
+
+                with ui.card():
+                    ui.label().bind_text_from(view, 'altered_limit_msg')
+                    with ui.button_group().props('outline rounded push'):
+                        ui.button('-30', on_click=lambda: change_limit(-30))
+                        ui.button('-10', on_click=lambda: change_limit(-10))
+                        ui.button('-5', on_click=lambda: change_limit(-5))
+                        ui.button('+5', on_click=lambda: change_limit(5)).props('outline')
+                        ui.button('+10', on_click=lambda: change_limit(10)).props('outline')
+                        ui.button('+30', on_click=lambda: change_limit(30)).props('outline')
+                    ui.label().bind_text_from(view, 'default_limit_msg').style('color:#CCC')
+
+                with ui.card():
+                    ui.label().bind_text_from(view, 'active_msg')
+                    ui.button(i18n.t('lock'), on_click=lambda: disable_user(True)).props('color=red')
+                    ui.button(i18n.t('unlock'), on_click=lambda: disable_user(False)).props('color=green')
+
+                with ui.expansion(i18n.t('history'), icon='insights', on_value_change=toggle_history):
+                    rollups = {'day': i18n.t('daily'), 'week': i18n.t('weekly'), 'month': i18n.t('monthly')}
+                    ui.toggle(rollups, value='day', on_change=change_rollup)
+                    chart = ui.echart({
+                        'tooltip': {'trigger': 'axis'},
+                        'legend': {},
+                        'xAxis': {'type': 'category', 'data': []},
+                        'yAxis': [{'type': 'value'}, {'type': 'value', 'minInterval': 1}],
+                        'series': [
+                            {'name': i18n.t('watched_series'), 'type': 'bar', 'data': [], 'color': 'purple'},
+                            {'name': i18n.t('limit_series'), 'type': 'line', 'data': [], 'step': 'middle'},
+                            {'name': i18n.t('locks_series'), 'type': 'scatter', 'data': [], 'yAxisIndex': 1},
+                        ],
+                    }).classes('w-96')
+                    ui.label(i18n.t('recent_events'))
+                    ui.label().bind_text_from(history, 'events').style('color:#888; white-space: pre-wrap')
+
+                with ui.expansion(i18n.t('tech'), icon='build').style('color:#CCC; font-size:-1'):
+                    link_style = 'color:#AAA; font-size:-1'
+                    url = f'{view["user_link"]}'
+                    link = ui.link(target=url, new_tab=True).bind_text_from(view, 'user_id').style(link_style)
+                    with ui.element('div').classes('p-2 bg-blue-100'):
+                        folders_style = 'color:#AAA; font-size:-1; white-space: pre-wrap'
+                        ui.label().bind_text_from(view, 'folders').style(folders_style)
+
+        except TimeoutError:  # ui.context.client.connected() may throw it
+            pass
+
+    ui.run(port=service.config.port, uvicorn_reload_includes='*.py')  # config.yaml is reloaded in place
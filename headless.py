@@ -0,0 +1,20 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI
+
+from service import WatchWiseService
+
+
+def run(service: WatchWiseService):
+    @asynccontextmanager
+    async def lifespan(_):
+        tasks = [asyncio.create_task(task()) for task in service.get_startup_tasks()]
+        yield
+        for task in tasks:
+            task.cancel()
+
+    app = FastAPI(title='JellyWatchWise', lifespan=lifespan)
+    service.register_routes(app)
+    uvicorn.run(app, host='0.0.0.0', port=service.config.port, log_level='warning')
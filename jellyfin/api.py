@@ -1,12 +1,13 @@
 import json
+import time
+from copy import deepcopy
 
-import requests
-
+from jellyfin.client import HttpClient, is_status
 from jellyfin.stats import AggregatedStatsSource
 
 
 class ServerApi:
-    def __init__(self, server, token, stats: AggregatedStatsSource):
+    def __init__(self, server, token, stats: AggregatedStatsSource, policy_ttl=60, client: HttpClient = None):
         self.server = server
         self.token = token
         self.headers = {'Authorization': f'MediaBrowser Token={self.token}',
@@ -14,34 +15,83 @@ class ServerApi:
                         'Content-Type': 'application/json'}
         self.decoder = json.JSONDecoder()
         self.stats = stats
+        self.client = client if client else HttpClient()
+        self.policy_ttl = policy_ttl
+        self.policy_cache = {}  # user_id -> (fetch time, policy)
+        self.sessions_cache = (0, None)  # the scheduler and live stats read sessions within the same tick
 
     def get_users(self):
         users = {}
-        r = requests.get(f'{self.server}/Users', headers=self.headers)
-        if r.status_code == 200:
+        r = self.client.get(f'{self.server}/Users', headers=self.headers, upstream='jellyfin')
+        if is_status(r, 200):
             users = self.decoder.decode(r.text)
             users = {x["Id"]: x["Name"] for x in users}
         return users
 
+    def get_sessions(self, active_within_sec=960, max_age_sec=2):
+        fetched, sessions = self.sessions_cache
+        if sessions is not None and time.monotonic() - fetched < max_age_sec:
+            return sessions
+        r = self.client.get(f'{self.server}/Sessions', headers=self.headers, upstream='jellyfin',
+                            params={'activeWithinSeconds': active_within_sec})
+        if is_status(r, 200):
+            sessions = self.decoder.decode(r.text)
+            self.sessions_cache = (time.monotonic(), sessions)
+            return sessions
+        return None
+
+    def stop_user_playback(self, user_id):
+        for session in self.get_sessions(max_age_sec=0) or []:
+            if session.get('UserId') == user_id and session.get('NowPlayingItem'):
+                r = self.client.post(f'{self.server}/Sessions/{session["Id"]}/Playing/Stop', headers=self.headers,
+                                     upstream='jellyfin')
+                if not is_status(r, 204):
+                    print("Error on stopping playback")
+
+    def get_playing_users(self):
+        sessions = self.get_sessions()
+        if sessions is None:
+            return None
+        return {x['UserId'] for x in sessions
+                if x.get('UserId') and x.get('NowPlayingItem') and not x.get('PlayState', {}).get('IsPaused')}
+
     def get_total_time_sec(self, user_id, date_start, date_end):
         return self.stats.get_total_time_sec(user_id, date_start, date_end)
 
+    def get_total_time_sec_many(self, user_ids, date_start, date_end):
+        return self.stats.get_total_time_sec_many(user_ids, date_start, date_end)
+
     def get_user_policy(self, user_id):
-        user = requests.get(f'{self.server}/Users/{user_id}', headers=self.headers)
-        if user.status_code != 200:
+        cached = self.policy_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < self.policy_ttl:
+            return deepcopy(cached[1])
+        user = self.client.get(f'{self.server}/Users/{user_id}', headers=self.headers, upstream='jellyfin')
+        if not is_status(user, 200):
             print("Error fetching user data")
-            return None
-        return self.decoder.decode(user.text)["Policy"]
+            return deepcopy(cached[1]) if cached else None  # server is failing, the last known policy is served
+        policy = self.decoder.decode(user.text)["Policy"]
+        self.cache_policy(user_id, policy)
+        return deepcopy(policy)
 
     def set_user_policy(self, user_id, policy):
-        r = requests.post(f'{self.server}/Users/{user_id}/Policy', headers=self.headers, data=json.dumps(policy))
-        if r.status_code != 204:
+        r = self.client.post(f'{self.server}/Users/{user_id}/Policy', headers=self.headers, upstream='jellyfin',
+                             data=json.dumps(policy))
+        if not is_status(r, 204):
             print("Error on updating user policy")
+            self.invalidate_policy(user_id)
+            return False
+        self.cache_policy(user_id, deepcopy(policy))
+        return True
 
-    def disable_user(self, user_id, is_disabled: bool):
-        policy = self.get_user_policy(user_id)
-        policy["IsDisabled"] = is_disabled
-        self.set_user_policy(user_id, policy)
+    def cache_policy(self, user_id, policy):
+        if self.policy_ttl > 0:
+            self.policy_cache[user_id] = (time.monotonic(), policy)
+
+    def invalidate_policy(self, user_id=None):
+        if user_id is None:
+            self.policy_cache.clear()
+        else:
+            self.policy_cache.pop(user_id, None)
 
     def is_user_disabled(self, user_id):
         policy = self.get_user_policy(user_id)
@@ -49,8 +99,3 @@ class ServerApi:
 
     def get_enabled_folders(self, user_id):
         return self.get_user_policy(user_id)["EnabledFolders"]
-
-    def set_enabled_folders(self, user_id, folders):
-        policy = self.get_user_policy(user_id)
-        policy["EnabledFolders"] = folders
-        self.set_user_policy(user_id, policy)
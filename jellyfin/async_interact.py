@@ -0,0 +1,173 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from config import logger
+from jellyfin.interact import ServerInteraction
+from jellyfin.snapshot import SnapshotHub
+from metrics import metrics
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# runs blocking ServerInteraction calls in worker threads, so the UI event loop never waits for the network;
+# poll cycles never overlap and each one has a time budget, users not reached within it wait for the next cycle
+class AsyncServerInteraction:
+    def __init__(self, interact: ServerInteraction, concurrency=4, slow_cycle_sec=10, poll_budget_sec=30):
+        self.interact = interact
+        self.slow_cycle_sec = slow_cycle_sec
+        self.poll_budget_sec = poll_budget_sec
+        self.cycles_in_flight = 0
+        self.cycle_lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        # own threads, so a slow server does not hold up the workers of other servers
+        self.executor = ThreadPoolExecutor(max(1, concurrency))
+        self.hub = SnapshotHub()
+
+    @property
+    def select_users(self):
+        return self.interact.select_users
+
+    async def run_io(self, func, *args, deadline=None):
+        async with self.semaphore:
+            if deadline is not None and time.monotonic() > deadline:
+                raise DeadlineExceeded()
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    async def gather_users(self, func, user_ids, args=None, deadline=None):
+        calls = [self.run_io(func, user_id, deadline=deadline) if args is None
+                 else self.run_io(func, user_id, args.get(user_id), deadline=deadline)
+                 for user_id in user_ids]
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        succeeded = {}
+        shed = 0
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, DeadlineExceeded):
+                shed += 1
+            elif isinstance(result, Exception):
+                logger.error(f'{func.__name__} failed for user {user_id}: {result!r}')
+            else:
+                succeeded[user_id] = result
+        if shed:
+            logger.warning(f'{func.__name__} of {shed} users left for the next cycle, poll budget exceeded')
+            metrics.inc('watchwise_poll_users_shed_total', shed, phase=func.__name__)
+        return succeeded
+
+    async def get_today_watched_min_many(self, user_ids):
+        return await self.run_io(self.interact.get_today_watched_min_many, list(user_ids))
+
+    def get_time_left(self, user_id):
+        state = self.hub.get(user_id)
+        return state['altered_limit'] - state['time_watched'] if state else float('-inf')
+
+    async def poll_users(self, user_ids=None, skip_if_busy=False):
+        kind = 'all' if user_ids is None else 'users'
+        if self.cycle_lock.locked():
+            if skip_if_busy:
+                logger.debug('poll cycle skipped, the previous one is still running')
+                metrics.inc('watchwise_poll_cycles_skipped_total', kind=kind)
+                return None
+            metrics.inc('watchwise_poll_cycle_overlaps_total', kind=kind)
+        async with self.cycle_lock:
+            return await self.run_cycle(kind, user_ids)
+
+    async def run_cycle(self, kind, user_ids):
+        # users closest to their limit go first, so they are not the ones left out when time runs short
+        user_ids = sorted(self.select_users if user_ids is None else user_ids, key=self.get_time_left)
+        self.cycles_in_flight += 1
+        metrics.set('watchwise_poll_cycles_in_flight', self.cycles_in_flight)
+        timings = {}
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.poll_budget_sec if self.poll_budget_sec else None
+        try:
+            watched = await self.get_today_watched_min_many(user_ids)
+            timings['stats'] = time.perf_counter() - start
+            if len(watched) < len(user_ids):
+                logger.warning(f'watch time of {len(user_ids) - len(watched)} users unknown, their folders are kept')
+            # without watch time only pending manual changes are applied, last known state stays on views
+            reconciled = await self.gather_users(self.interact.reconciler.reconcile_user, user_ids, watched, deadline)
+            watched = {user_id: x for user_id, x in watched.items() if user_id in reconciled}
+            changes = {user_id: x for user_id, x in reconciled.items() if x}
+            if changes:
+                logger.info(f'policies updated for {len(changes)} of {len(user_ids)} users')
+            timings['reconcile'] = time.perf_counter() - start - sum(timings.values())
+            await self.run_io(self.interact.record_usage, watched)
+            await self.refresh_snapshots(list(watched), watched, deadline)
+            await self.run_io(self.interact.save_state)
+            timings['snapshots'] = time.perf_counter() - start - sum(timings.values())
+            return watched
+        finally:
+            self.cycles_in_flight -= 1
+            metrics.set('watchwise_poll_cycles_in_flight', self.cycles_in_flight)
+            self.report_cycle(kind, len(user_ids), time.perf_counter() - start, timings)
+
+    def report_cycle(self, kind, users_count, duration, timings):
+        metrics.inc('watchwise_poll_cycles_total', kind=kind)
+        metrics.observe('watchwise_poll_cycle_seconds', duration, kind=kind)
+        phases = ', '.join(f'{k} {v:.3f}s' for k, v in timings.items())
+        server = f' at {self.interact.config.name}' if self.interact.config.name else ''
+        message = f'poll cycle of {users_count} users{server} took {duration:.3f}s ({phases})'
+        cycle = {'server': self.interact.config.name, 'kind': kind, 'users': users_count,
+                 'duration_sec': round(duration, 4), **{f'{k}_sec': round(v, 4) for k, v in timings.items()}}
+        if self.slow_cycle_sec and duration > self.slow_cycle_sec:
+            logger.warning(f'slow {message}', extra={'cycle': cycle})
+        else:
+            logger.debug(message, extra={'cycle': cycle})
+
+    async def refresh_server_state(self):
+        users = await self.run_io(self.interact.api.get_users)
+        if not users:
+            logger.warning('users not refreshed from the server, restored state is used')
+            return
+        select_users = self.interact.config.get_select_users(users)
+        entries = await self.gather_users(self.interact.get_user_entry, list(select_users))
+        await self.run_io(self.interact.update_users, users, entries)  # reads and writes the state backend
+        logger.info(f'state of {len(entries)} users refreshed from the server')
+
+    async def get_user_states(self, user_ids, watched=None, deadline=None):
+        user_ids = list(dict.fromkeys(user_ids))
+        if watched is None:
+            watched = await self.get_today_watched_min_many(user_ids)
+        user_ids = [x for x in user_ids if x in watched]  # no watch time, no fresh state
+        return await self.gather_users(self.interact.get_user_state, user_ids, watched, deadline)
+
+    async def refresh_snapshots(self, user_ids, watched=None, deadline=None):
+        states = await self.get_user_states(user_ids, watched, deadline)
+        self.hub.publish_many(states)
+        return states
+
+    async def refresh_subscribed(self):
+        user_ids = self.hub.subscribed_users()
+        if user_ids:
+            await self.refresh_snapshots(list(user_ids))
+
+    async def subscribe(self, key, user_id, callback):
+        if not self.hub.subscribe(key, user_id, callback):
+            await self.refresh_snapshots([user_id])
+
+    def unsubscribe(self, key):
+        self.hub.unsubscribe(key)
+
+    async def get_history(self, user_id, rollup='day', count=30):
+        return await self.run_io(self.interact.history.get_series, user_id, rollup, count)
+
+    async def get_events(self, user_id, count=10):
+        return await self.run_io(self.interact.history.get_events, user_id, count)
+
+    async def alter_limit(self, user_id, diff):
+        await self.run_io(self.interact.alter_limit, user_id, diff)
+
+    async def disable_user(self, user_id, is_disabled: bool = False):
+        await self.run_io(self.interact.disable_user, user_id, is_disabled)
+
+    async def check_new_day(self):
+        if not await self.run_io(self.interact.has_new_day_begun):
+            return False
+        logger.info('new day reset')
+        await self.run_io(self.interact.reset_altered_limits)
+        self.interact.reset_stats()
+        self.interact.enable_accounts()
+        return True
@@ -0,0 +1,97 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from config import logger
+
+
+def get_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+# state that has to be the same for every process serving the app: altered limits, the current day and the lease
+# of the enforcement poll; the in-memory backend keeps it in this process, which is enough for a single process
+class MemoryBackend:
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.leases = {}  # name -> (owner, expiry time)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.values.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def advance(self, key, value):
+        # sets an increasing value (e.g. a date), tells whether this call was the one that changed it
+        with self.lock:
+            current = self.values.get(key)
+            if current is not None and current >= value:
+                return False
+            self.values[key] = value
+            return True
+
+    def acquire_lease(self, name, owner, ttl_sec):
+        now = time.time()
+        with self.lock:
+            holder, expires = self.leases.get(name, (None, 0))
+            if holder not in (None, owner) and expires > now:
+                return False
+            self.leases[name] = (owner, now + ttl_sec)
+            return True
+
+
+# the same state in a SQLite file, for several processes or replicas sharing the config volume
+class SqliteBackend(MemoryBackend):
+    shared = True
+
+    def __init__(self, db_name='config/shared-state.db'):
+        super().__init__()
+        self.db = sqlite3.connect(db_name, check_same_thread=False, timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL,'
+                        ' expires REAL NOT NULL)')
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def advance(self, key, value):
+        # a single statement, so of the processes advancing the same key exactly one succeeds
+        with self.lock, self.db:
+            cursor = self.db.execute('INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE'
+                                     ' SET value = excluded.value WHERE state.value < excluded.value',
+                                     (key, json.dumps(value)))
+            return cursor.rowcount > 0
+
+    def acquire_lease(self, name, owner, ttl_sec):
+        now = time.time()
+        with self.lock, self.db:
+            cursor = self.db.execute('INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) ON CONFLICT (name)'
+                                     ' DO UPDATE SET owner = excluded.owner, expires = excluded.expires'
+                                     ' WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                                     (name, owner, now + ttl_sec, now))
+            return cursor.rowcount > 0
+
+
+def create_backend(config):
+    if config.state_backend == 'sqlite':
+        logger.info(f'shared state kept in {config.state_db}')
+        return SqliteBackend(config.state_db)
+    if config.state_backend != 'memory':
+        logger.warning(f'unknown state backend {config.state_backend}, memory is used')
+    return MemoryBackend()
@@ -0,0 +1,58 @@
+import threading
+import time
+
+from config import logger
+from metrics import metrics
+
+
+# stops calling an upstream that keeps failing: after `failures` errors in a row requests are refused for
+# reset_sec (doubled on every failed trial, up to max_reset_sec), then a single trial request is let through
+class CircuitBreaker:
+    def __init__(self, name, failures=3, reset_sec=30, max_reset_sec=300, server='server'):
+        self.name = name
+        self.server = server
+        self.failures = failures
+        self.reset_sec = reset_sec
+        self.max_reset_sec = max_reset_sec
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.open_sec = reset_sec
+        self.opened = None  # monotonic time of opening, None when closed
+        self.trial = False
+
+    def allow(self):
+        if self.failures <= 0:
+            return True
+        with self.lock:
+            if self.opened is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened >= self.open_sec:
+                self.trial = True  # half-open, this request decides
+                return True
+        metrics.inc('watchwise_upstream_short_circuits_total', server=self.server, upstream=self.name)
+        return False
+
+    def record(self, success):
+        if self.failures <= 0:
+            return
+        with self.lock:
+            if success:
+                if self.opened is not None:
+                    logger.info(f'{self.name} of {self.server} is available again, circuit closed')
+                self.failed = 0
+                self.opened = None
+                self.trial = False
+                self.open_sec = self.reset_sec
+            elif self.trial:
+                self.trial = False
+                self.opened = time.monotonic()
+                self.open_sec = min(self.open_sec * 2, self.max_reset_sec)
+                logger.warning(f'{self.name} of {self.server} still failing, next trial in {self.open_sec:g}s')
+            else:
+                self.failed += 1
+                if self.opened is None and self.failed >= self.failures:
+                    self.opened = time.monotonic()
+                    logger.warning(f'{self.name} of {self.server} failed {self.failed} times,'
+                                   f' requests paused for {self.open_sec:g}s')
+            metrics.set('watchwise_upstream_circuit_open', 0 if self.opened is None else 1, server=self.server,
+                        upstream=self.name)
@@ -0,0 +1,70 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import logger
+from jellyfin.breaker import CircuitBreaker
+from metrics import get_endpoint, metrics
+
+
+class HttpClient:
+    def __init__(self, timeout=10, connect_timeout=5, retries=2, retry_backoff=0.5, max_connections_per_host=4,
+                 breaker_failures=3, breaker_reset_sec=30, breaker_max_reset_sec=300, server='server'):
+        self.server = server  # name of the configured server, labels metrics of its upstreams
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.breaker_args = (breaker_failures, breaker_reset_sec, breaker_max_reset_sec)
+        self.breakers = {}  # upstream name -> CircuitBreaker
+        # all upstream calls are idempotent (queries and full policy replacement), so POSTs are retried as well
+        retry = Retry(total=retries, backoff_factor=retry_backoff, status_forcelist=(429, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=max_connections_per_host, pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.http_timeout, config.http_connect_timeout, config.http_retries, config.http_retry_backoff,
+                   config.http_max_connections_per_host, config.http_breaker_failures, config.http_breaker_reset_sec,
+                   config.http_breaker_max_reset_sec, config.name or 'server')
+
+    def get_breaker(self, upstream):
+        if upstream not in self.breakers:
+            self.breakers[upstream] = CircuitBreaker(upstream, *self.breaker_args, server=self.server)
+        return self.breakers[upstream]
+
+    def request(self, method, url, timeout=None, upstream=None, **kwargs):
+        breaker = self.get_breaker(upstream) if upstream else None
+        if breaker and not breaker.allow():
+            return None
+        read_timeout = timeout if timeout else self.timeout
+        endpoint = get_endpoint(url)
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, url, timeout=(self.connect_timeout, read_timeout), **kwargs)
+            status = r.status_code
+        except requests.RequestException as e:
+            logger.error(f'{method} {url} failed: {e}')
+            r = None
+            status = type(e).__name__
+        labels = {'server': self.server, 'method': method, 'endpoint': endpoint}
+        metrics.observe('watchwise_upstream_request_seconds', time.perf_counter() - start, **labels)
+        metrics.inc('watchwise_upstream_requests_total', status=status, **labels)
+        if r is None or r.status_code >= 400:
+            metrics.inc('watchwise_upstream_errors_total', **labels)
+        if breaker:
+            breaker.record(r is not None and r.status_code < 500)
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+def is_status(response, status_code):
+    return response is not None and response.status_code == status_code
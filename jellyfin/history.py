@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+import time
+from datetime import date
+
+ROLLUPS = ('day', 'week', 'month')
+
+
+def get_periods(day):
+    year, week, _ = date.fromisoformat(day).isocalendar()
+    return {'day': day, 'week': f'{year}-W{week:02d}', 'month': day[:7]}
+
+
+# local time series of daily usage, kept together with weekly and monthly rollups updated on every write,
+# so history views read a handful of pre-aggregated rows and never touch the servers
+class UsageHistory:
+    def __init__(self, db_name='config/history.db', cached=True):
+        self.lock = threading.Lock()
+        self.cached = cached  # off when other processes write the same file
+        self.db = sqlite3.connect(db_name, check_same_thread=False, timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS events (time REAL NOT NULL, user_id TEXT NOT NULL,'
+                        ' kind TEXT NOT NULL, value INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS events_by_user ON events (user_id, time)')
+        for rollup in ROLLUPS:
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS usage_{rollup} (user_id TEXT NOT NULL, period TEXT NOT NULL,'
+                            f' watched INTEGER NOT NULL DEFAULT 0, limit_sum INTEGER NOT NULL DEFAULT 0,'
+                            f' days INTEGER NOT NULL DEFAULT 0, locks INTEGER NOT NULL DEFAULT 0,'
+                            f' PRIMARY KEY (user_id, period))')
+        self.days = {}  # user_id -> (day, watched, limit) as last written
+
+    def get_day(self, user_id, day):
+        known = self.days.get(user_id) if self.cached else None
+        if known and known[0] == day:
+            return known
+        row = self.db.execute('SELECT watched, limit_sum FROM usage_day WHERE user_id = ? AND period = ?',
+                              (user_id, day)).fetchone()
+        return (day, *row) if row else None
+
+    def add(self, user_id, day, watched=0, limit=0, days=0, locks=0):
+        for rollup, period in get_periods(day).items():
+            self.db.execute(f'INSERT INTO usage_{rollup} (user_id, period) VALUES (?, ?)'
+                            f' ON CONFLICT (user_id, period) DO NOTHING', (user_id, period))
+            self.db.execute(f'UPDATE usage_{rollup} SET watched = watched + ?, limit_sum = limit_sum + ?,'
+                            f' days = days + ?, locks = locks + ? WHERE user_id = ? AND period = ?',
+                            (watched, limit, days, locks, user_id, period))
+
+    def record_usage(self, user_id, day, watched, limit):
+        with self.lock:
+            if self.cached and self.days.get(user_id) == (day, watched, limit):
+                return
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')  # the delta is taken from the row as stored at commit
+                known = self.get_day(user_id, day)
+                if known == (day, watched, limit):
+                    return
+                if known:
+                    self.add(user_id, day, watched - known[1], limit - known[2])
+                else:
+                    self.add(user_id, day, watched, limit, days=1)
+            self.days[user_id] = (day, watched, limit)
+
+    def record_event(self, user_id, day, kind, value=None):
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO events (time, user_id, kind, value) VALUES (?, ?, ?, ?)',
+                            (time.time(), user_id, kind, value))
+            if kind == 'lock':
+                self.add(user_id, day, locks=1)
+
+    def get_series(self, user_id, rollup='day', count=30):
+        if rollup not in ROLLUPS:
+            raise ValueError(f'unknown rollup: {rollup}')
+        with self.lock:
+            rows = self.db.execute(f'SELECT period, watched, limit_sum, days, locks FROM usage_{rollup}'
+                                   f' WHERE user_id = ? ORDER BY period DESC LIMIT ?', (user_id, count)).fetchall()
+        return [{'period': period, 'watched': watched, 'limit': limit_sum, 'days': days, 'locks': locks}
+                for period, watched, limit_sum, days, locks in reversed(rows)]
+
+    def get_events(self, user_id, count=20):
+        with self.lock:
+            rows = self.db.execute('SELECT time, kind, value FROM events WHERE user_id = ?'
+                                   ' ORDER BY time DESC LIMIT ?', (user_id, count)).fetchall()
+        return [{'time': t, 'kind': kind, 'value': value} for t, kind, value in rows]
@@ -1,62 +1,167 @@
+import json
 import os.path
+import sqlite3
+import threading
 from datetime import datetime, timedelta
 
 import i18n
 import yaml
 
+import misc
 from config import logger
 from jellyfin.api import ServerApi
-from jellyfin.stats import PlaytimeReporting, JellyStats
+from jellyfin.backend import MemoryBackend
+from jellyfin.client import HttpClient
+from jellyfin.history import UsageHistory
+from jellyfin.reconcile import PolicyReconciler
+from jellyfin.state import StateSnapshot
+from jellyfin.stats import IncrementalStats, JellyStats, JellyStatsMirror, LivePlaybackStats, PlaytimeReporting
+from metrics import metrics
 from misc import clip
 
 
 class FoldersBackup:
-    def __init__(self):
-        self.folder_backup_name = 'config/user-folders.bck'
+    def __init__(self, db_name='config/user-folders.db', legacy_name='config/user-folders.bck', cached=True):
+        self.lock = threading.Lock()  # lockers of different users may run in parallel threads
+        self.cached = cached  # without the cache backups written by other processes are seen at once
+        self.db = sqlite3.connect(db_name, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS user_folders (user_id TEXT PRIMARY KEY, folders TEXT NOT NULL)')
+        self.folders = {user_id: json.loads(folders)
+                        for user_id, folders in self.db.execute('SELECT user_id, folders FROM user_folders')}
+        if not self.folders:
+            self.import_legacy_backup(legacy_name)
+
+    def import_legacy_backup(self, legacy_name):
+        if os.path.isfile(legacy_name):
+            with open(legacy_name, 'r') as file:
+                backup = yaml.safe_load(file) or {}
+            logger.info(f'importing folders backup of {len(backup)} users from {legacy_name}')
+            for user_id, folders in backup.items():
+                self.keep_user_folders(user_id, folders)
+
+    def get_user_folders(self, user_id):
+        if self.cached:
+            return self.folders.get(user_id)
+        row = self.db.execute('SELECT folders FROM user_folders WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
 
     def keep_user_folders(self, user_id, folders):
         count = len(folders)
         logger.debug(f'keep folders of user {user_id}, total {count}')
         if count > 0:
-            folders_collection = {}
-            if os.path.isfile(self.folder_backup_name):
-                with open(self.folder_backup_name, 'r') as file:
-                    folders_collection = yaml.safe_load(file)
-            folders_collection[user_id] = folders
-            with open(self.folder_backup_name, 'w') as file:
-                yaml.dump(folders_collection, file)
+            with self.lock:
+                if self.get_user_folders(user_id) == folders:
+                    return
+                self.folders[user_id] = list(folders)
+                with self.db:
+                    self.db.execute('INSERT OR REPLACE INTO user_folders (user_id, folders) VALUES (?, ?)',
+                                    (user_id, json.dumps(folders)))
 
     def restore_user_folders(self, user_id):
         logger.debug(f'restore user folders {user_id}')
-        if os.path.isfile(self.folder_backup_name):
-            with open(self.folder_backup_name, 'r') as file:
-                backup = yaml.safe_load(file)
-                if user_id in backup:
-                    return backup[user_id]
-        return []
+        with self.lock:
+            return list(self.get_user_folders(user_id) or [])
 
 
 class ServerInteraction:
-    def __init__(self, config):
+    def __init__(self, config, snapshot: StateSnapshot = None, backend: MemoryBackend = None):
         self.config = config
-        self.backup = FoldersBackup()
+        self.snapshot = snapshot
+        self.state_lock = threading.Lock()  # saves come from poll cycles, GUI actions and reloads at once
+        self.backend = backend if backend else MemoryBackend()
+        self.backup = FoldersBackup(cached=not self.backend.shared)
+        self.history = UsageHistory(cached=not self.backend.shared)
+        self.client = HttpClient.from_config(config)
         if config.stats_host:
-            stats = JellyStats(config.stats_host, config.stats_token)
+            stats = JellyStats(config.stats_host, config.stats_token, self.client, config.http_stats_timeout)
+            if config.stats_mirror:
+                stats = JellyStatsMirror(stats, config.stats_db, config.stats_settle_hours)
         else:
-            stats = PlaytimeReporting(config.host, config.token)
-        self.api = ServerApi(config.host, config.token, stats)
-        self.select_users = config.get_select_users(self.api.get_users())
-        self.user_data = self.get_user_data()
+            stats = PlaytimeReporting(config.host, config.token, self.client, config.http_stats_timeout)
+            if config.stats_incremental:
+                stats = IncrementalStats(stats, config.stats_settle_hours)
+        self.api = ServerApi(config.host, config.token, stats, config.policy_cache_ttl, self.client)
+        if config.live_playback:
+            self.api.stats = LivePlaybackStats(stats, self.api.get_sessions)
+        self.reconciler = PolicyReconciler(self)
+        self.today = misc.get_today()
+        self.restored = self.load_state()
+        if not self.restored:
+            self.users = self.api.get_users()
+            self.select_users = config.get_select_users(self.users)
+            self.user_data = self.get_user_data()
+            self.add_missing_users()
+            self.save_state()
+        self.backend.advance(self.get_state_key('today'), self.today)
+
+    def load_state(self):
+        state = self.snapshot.load() if self.snapshot else None
+        if not state:
+            return False
+        self.users = state['users']
+        self.select_users = self.config.get_select_users(self.users)
+        self.user_data = state['user_data']
+        self.add_missing_users()
+        self.today = state['today']  # a day that passed while the app was down gets its reset on the next poll
+        if state.get('playbacks') and isinstance(self.api.stats, LivePlaybackStats):
+            self.api.stats.set_state(state['playbacks'])
+        logger.info(f'state of {len(self.select_users)} users restored from {self.snapshot.name}')
+        return True
+
+    def save_state(self):
+        if not self.snapshot:
+            return
+        with self.state_lock:
+            # entries are copied first, other threads may change them while the copy is written
+            user_data = {user_id: dict(entry) for user_id, entry in list(self.user_data.items())}
+            state = {'today': self.today, 'users': self.users, 'user_data': user_data}
+            if isinstance(self.api.stats, LivePlaybackStats):
+                state['playbacks'] = self.api.stats.get_state()
+            self.snapshot.save(state)
 
     def get_user_data(self):
-        user_data = {}
+        return {user_id: self.get_user_entry(user_id) for user_id in self.select_users}
+
+    def get_user_entry(self, user_id):
+        limit = self.config.get_limit(user_id)
+        folders = self.api.get_enabled_folders(user_id)
+        if not self.are_only_unlimited_folders(folders):
+            self.backup.keep_user_folders(user_id, folders)
+        return {'folders': folders, 'altered_limit': limit}
+
+    def update_users(self, users, entries):
+        # live server state replaces the restored one, while today's limit adjustments are kept
+        for user_id, entry in entries.items():
+            known = self.user_data.get(user_id)
+            if known:
+                entry['altered_limit'] = self.get_altered_limit(user_id)
+                if self.are_only_unlimited_folders(entry['folders']):
+                    entry['folders'] = known['folders']  # locked now, keep the folders to restore
+                if 'disabled' in known:
+                    entry['disabled'] = known['disabled']
+            self.user_data[user_id] = entry
+        self.users = users
+        self.select_users = self.config.get_select_users(users)
+        self.add_missing_users()
+        self.save_state()
+
+    def apply_config(self, config):
+        self.config = config
+        self.select_users = config.get_select_users(self.users)
+        self.add_missing_users()
+        for user_id in self.select_users:
+            self.user_data[user_id]['altered_limit'] = self.get_altered_limit(user_id)
+        self.save_state()
+
+    def add_missing_users(self):
         for user_id in self.select_users:
-            limit = self.config.get_limit(user_id)
-            folders = self.api.get_enabled_folders(user_id)
-            if not self.are_only_unlimited_folders(folders):
-                self.backup.keep_user_folders(user_id, folders)
-            user_data[user_id] = {'folders': folders, 'altered_limit': limit}
-        return user_data
+            entry = self.user_data.setdefault(user_id, {'folders': [], 'altered_limit': self.config.get_limit(user_id)})
+            if self.backend.get(self.get_state_key('limit', user_id)) is None:
+                self.set_altered_limit(user_id, entry['altered_limit'])
+
+    def get_state_key(self, *parts):
+        return '/'.join([self.config.name or 'server', *parts])
 
     def are_only_unlimited_folders(self, folders):
         return len(folders) == 0 or all(x in self.config.no_limit_folders for x in folders)
@@ -64,63 +169,101 @@ class ServerInteraction:
     def keep_unlimited_folders(self, folders):
         return [x for x in folders if x in self.config.no_limit_folders]
 
-    def media_folders_locker(self, user_id):
-        logger.debug('media folders lock/unlock')
-        time = self.get_today_watched_min(user_id)
-        time_left = self.user_data[user_id]['altered_limit'] - time
-        folders = self.api.get_enabled_folders(user_id)
-        if not self.are_only_unlimited_folders(folders):
-            self.backup.keep_user_folders(user_id, folders)
-        if time_left > 0:
-            prev_folders = self.user_data[user_id]['folders']
-            if self.are_only_unlimited_folders(prev_folders):
-                prev_folders = self.backup.restore_user_folders(user_id)
-            if len(prev_folders) > 0 and len(prev_folders) > len(folders):
-                self.api.set_enabled_folders(user_id, prev_folders)
-                logger.info('folders restored')
-        else:
-            if not self.are_only_unlimited_folders(folders):
-                self.user_data[user_id]['folders'] = folders  # store all folders for later restore
-                kept_folders = self.keep_unlimited_folders(folders)
-                self.api.set_enabled_folders(user_id, kept_folders)
-                logger.info('folders disabled - soft lock action')
-
-    def get_today_watched_min(self, user_id):
+    @staticmethod
+    def get_today_range():
         now = datetime.today()
         date_start = now.strftime('%Y-%m-%d')
         date_end = (now + timedelta(1)).strftime('%Y-%m-%d')
         # date_start = '2024-11-09'
         # date_end = '2024-11-10'
-        time = self.api.get_total_time_sec(user_id, date_start, date_end) // 60
-        return time
+        return date_start, date_end
+
+    def get_today_watched_min(self, user_id):
+        date_start, date_end = self.get_today_range()
+        time_sec = self.api.get_total_time_sec(user_id, date_start, date_end)
+        return None if time_sec is None else time_sec // 60
+
+    def get_today_watched_min_many(self, user_ids):
+        date_start, date_end = self.get_today_range()
+        with metrics.timer('watchwise_stats_query_seconds', source=self.api.stats.name):
+            times = self.api.get_total_time_sec_many(user_ids, date_start, date_end)
+        return {user_id: time_sec // 60 for user_id, time_sec in times.items()}
+
+    def record_usage(self, watched):
+        day = misc.get_today()
+        for user_id, time_watched in watched.items():
+            self.history.record_usage(user_id, day, time_watched, self.get_altered_limit(user_id))
+
+    def record_event(self, user_id, kind, value=None):
+        self.history.record_event(user_id, misc.get_today(), kind, value)
+
+    def has_new_day_begun(self):
+        # tracked per server, each one gets its own reset; of processes sharing the state only one does it
+        if self.today == misc.get_today():
+            return False
+        self.today = misc.get_today()
+        return self.backend.advance(self.get_state_key('today'), self.today)
+
+    def reset_stats(self):
+        self.api.stats.reset()
+
+    def invalidate_user(self, user_id=None):
+        self.api.invalidate_policy(user_id)
 
     def disable_user(self, user_id, is_disabled: bool = False):
-        self.api.disable_user(user_id, is_disabled)
+        self.user_data[user_id]['disabled'] = is_disabled
+        return self.reconciler.reconcile_user(user_id)
 
     def reset_altered_limits(self):
         for user_id in self.select_users:
-            self.user_data[user_id]['altered_limit'] = self.config.get_limit(user_id)
+            self.set_altered_limit(user_id, self.config.get_limit(user_id))
 
     def alter_limit(self, user_id, diff):
-        current_limit = self.user_data[user_id]['altered_limit']
-        self.user_data[user_id]['altered_limit'] = clip(current_limit + diff, 0, 360)
+        limit = clip(self.get_altered_limit(user_id) + diff, 0, 360)
+        self.set_altered_limit(user_id, limit)
+        self.save_state()
+        self.record_event(user_id, 'limit', limit)
+
+    def set_altered_limit(self, user_id, limit):
+        self.user_data[user_id]['altered_limit'] = limit
+        # kept with the configured limit it was based on, so a changed configuration moves it by the same amount
+        self.backend.set(self.get_state_key('limit', user_id), [limit, self.config.get_limit(user_id)])
 
     def get_altered_limit(self, user_id):
-        return self.user_data[user_id]['altered_limit']
+        stored = self.backend.get(self.get_state_key('limit', user_id))
+        limit = self.config.get_limit(user_id)
+        if stored is None:
+            return self.user_data[user_id]['altered_limit']
+        if limit is None or stored[1] is None:
+            return stored[0]
+        return clip(stored[0] + limit - stored[1], 0, 360)
 
     def enable_accounts(self):
+        # applied by the next reconciliation pass, together with the folders of the new day
         if self.config.account_enable_on_day_reset:
             for user_id in self.select_users:
-                self.disable_user(user_id, False)
-
-    def refresh_view(self, view, user_id):
-        logger.debug('refresh_view started for {}'.format(self.select_users[user_id]))
-        is_disabled = self.api.is_user_disabled(user_id)
-        time_watched = self.get_today_watched_min(user_id)
-        altered_limit = self.get_altered_limit(user_id)
-        default_limit = self.config.get_limit(user_id)
+                self.user_data[user_id]['disabled'] = False
+
+    def get_user_state(self, user_id, time_watched=None):
+        if time_watched is None:
+            time_watched = self.get_today_watched_min(user_id)
+        return {
+            'user_id': user_id,
+            'is_disabled': self.api.is_user_disabled(user_id),
+            'time_watched': time_watched,
+            'altered_limit': self.get_altered_limit(user_id),
+            'default_limit': self.config.get_limit(user_id),
+            'folders': self.user_data[user_id]['folders'],
+        }
+
+    def fill_view(self, view, user_id, state):
+        logger.debug('fill_view started for {}'.format(self.select_users[user_id]))
+        is_disabled = state['is_disabled']
+        time_watched = state['time_watched']
+        altered_limit = state['altered_limit']
+        default_limit = state['default_limit']
         time_left = altered_limit - time_watched
-        folders = self.user_data[user_id]['folders']
+        folders = state['folders']
 
         if view['user_id'] != user_id:
             view['user_id'] = user_id
@@ -132,5 +275,5 @@ class ServerInteraction:
         view['default_limit_msg'] = i18n.t('default', t=default_limit)
         view['altered_limit_msg'] = i18n.t('today', t=altered_limit)
         view['active_msg'] = i18n.t('disabled') if is_disabled else i18n.t('enabled')
-        view['progress'] = time_watched / altered_limit
+        view['progress'] = time_watched / altered_limit if altered_limit > 0 else 1
         view['folders'] = "Folders:\n" + " \n".join(folders)
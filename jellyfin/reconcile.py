@@ -0,0 +1,65 @@
+from config import logger
+
+
+# works out the target policy of a user (enabled folders and account state) from limits, usage
+# and pending manual changes, then sends only the differences to the server
+class PolicyReconciler:
+    def __init__(self, interact):
+        self.interact = interact
+
+    def get_target_folders(self, user_id, folders, time_watched):
+        interact = self.interact
+        user_data = interact.user_data[user_id]
+        if not interact.are_only_unlimited_folders(folders):
+            interact.backup.keep_user_folders(user_id, folders)
+        time_left = interact.get_altered_limit(user_id) - time_watched
+        if time_left > 0:
+            prev_folders = user_data['folders']
+            if interact.are_only_unlimited_folders(prev_folders):
+                prev_folders = interact.backup.restore_user_folders(user_id)
+            if len(prev_folders) > 0 and len(prev_folders) > len(folders):
+                return prev_folders
+        elif not interact.are_only_unlimited_folders(folders):
+            user_data['folders'] = folders  # store all folders for later restore
+            return interact.keep_unlimited_folders(folders)
+        return folders
+
+    def get_changes(self, user_id, policy, time_watched):
+        changes = {}
+        if time_watched is not None:
+            folders = self.get_target_folders(user_id, policy['EnabledFolders'], time_watched)
+            if folders != policy['EnabledFolders']:
+                changes['EnabledFolders'] = folders
+        is_disabled = self.interact.user_data[user_id].get('disabled')
+        if is_disabled is not None and is_disabled != policy['IsDisabled']:
+            changes['IsDisabled'] = is_disabled
+        return changes
+
+    def reconcile_user(self, user_id, time_watched=None):
+        api = self.interact.api
+        policy = api.get_user_policy(user_id)
+        if policy is None:
+            return {}
+        changes = self.get_changes(user_id, policy, time_watched)
+        if changes:
+            logger.info(f'user {user_id} policy update: {", ".join(f"{k}={v}" for k, v in changes.items())}')
+            policy.update(changes)
+            if not api.set_user_policy(user_id, policy):
+                return {}
+            self.report(user_id, policy, changes)
+        self.interact.user_data[user_id].pop('disabled', None)  # manual change is applied (or was not needed)
+        return changes
+
+    def report(self, user_id, policy, changes):
+        if 'EnabledFolders' in changes:
+            if self.interact.are_only_unlimited_folders(policy['EnabledFolders']):
+                logger.info('folders disabled - soft lock action')
+                self.interact.record_event(user_id, 'lock')
+                if self.interact.config.stop_playback_on_lock:
+                    self.interact.api.stop_user_playback(user_id)
+                    logger.info('playback stopped')
+            else:
+                logger.info('folders restored')
+                self.interact.record_event(user_id, 'unlock')
+        if 'IsDisabled' in changes:
+            self.interact.record_event(user_id, 'disabled' if changes['IsDisabled'] else 'enabled')
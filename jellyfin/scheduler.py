@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from config import logger
+from jellyfin.async_interact import AsyncServerInteraction
+from misc import clip
+
+
+# checks each user when needed instead of all users at a fixed rate:
+# shortly before a playing user runs out of time, and rarely when the user is idle
+class LockScheduler:
+    def __init__(self, engine: AsyncServerInteraction, session_check_sec=30, active_check_sec=60,
+                 idle_check_sec=900, min_delay_sec=5):
+        self.engine = engine
+        self.session_check_sec = session_check_sec
+        self.active_check_sec = active_check_sec
+        self.idle_check_sec = idle_check_sec
+        self.min_delay_sec = min_delay_sec
+        self.next_check = {}  # user_id -> monotonic time of the next check
+        self.enabled = True  # when false, only views are refreshed
+        self.playing = set()
+
+    @classmethod
+    def from_config(cls, engine, config):
+        scheduler = cls(engine)
+        scheduler.apply_config(config)
+        return scheduler
+
+    def apply_config(self, config):
+        self.session_check_sec = config.session_check_interval * 60
+        self.active_check_sec = config.active_check_interval * 60
+        self.idle_check_sec = config.idle_check_interval * 60
+
+    def check_soon(self, user_id=None):
+        for x in [user_id] if user_id else list(self.next_check):
+            self.next_check[x] = 0
+
+    def update(self, user_id, time_watched):
+        self.schedule(user_id, time_watched, time.monotonic())
+
+    async def run(self):
+        logger.info('predictive lock scheduler started')
+        while True:
+            try:
+                if self.enabled:
+                    await self.tick()
+                else:
+                    await self.engine.refresh_subscribed()
+            except Exception as e:
+                logger.error(f'lock scheduler failed: {e!r}')
+            await asyncio.sleep(self.get_sleep_sec())
+
+    def get_sleep_sec(self):
+        # wakes up for the next planned check, sessions are still checked at least every session_check_sec
+        if not self.enabled or not self.next_check:
+            return self.session_check_sec
+        due_sec = min(self.next_check.values()) - time.monotonic()
+        return clip(due_sec, 1, self.session_check_sec)  # never spins when checks keep failing
+
+    async def tick(self):
+        if await self.engine.check_new_day():
+            self.check_soon()
+        playing = await self.engine.run_io(self.engine.interact.api.get_playing_users)
+        if playing is None:
+            playing = self.playing  # sessions unknown, keep the previous playback state
+        started = playing - self.playing
+        self.playing = playing
+
+        now = time.monotonic()
+        due = [x for x in self.engine.select_users if x in started or self.next_check.get(x, 0) <= now]
+        if due:
+            logger.debug(f'scheduled check of {len(due)} users')
+            watched = await self.engine.poll_users(due)
+            for user_id in due:
+                self.schedule(user_id, watched.get(user_id), now)
+
+    def schedule(self, user_id, time_watched, now):
+        if time_watched is None:
+            delay = self.active_check_sec  # the check failed, retry soon
+        elif user_id not in self.playing:
+            delay = self.idle_check_sec  # playback start is noticed by the sessions check anyway
+        else:
+            state = self.engine.hub.get(user_id)  # refreshed by the check, the shared state is not read again
+            time_left_sec = (state['altered_limit'] - time_watched) * 60 if state else 0
+            if time_left_sec > 0:
+                delay = clip(time_left_sec, self.min_delay_sec, self.active_check_sec)
+            else:
+                delay = self.active_check_sec
+        self.next_check[user_id] = now + delay
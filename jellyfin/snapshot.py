@@ -0,0 +1,40 @@
+from config import logger
+
+
+class SnapshotHub:
+    def __init__(self):
+        self.snapshots = {}  # user_id -> latest user state
+        self.subscribers = {}  # subscriber key (e.g. client id) -> (user_id, callback)
+
+    def get(self, user_id):
+        return self.snapshots.get(user_id)
+
+    def subscribe(self, key, user_id, callback):
+        self.subscribers[key] = (user_id, callback)
+        snapshot = self.snapshots.get(user_id)
+        if snapshot:
+            self.notify(callback, snapshot)
+        return snapshot is not None
+
+    def unsubscribe(self, key):
+        self.subscribers.pop(key, None)
+
+    def subscribed_users(self):
+        return {user_id for user_id, _ in self.subscribers.values()}
+
+    def publish(self, user_id, snapshot):
+        self.snapshots[user_id] = snapshot
+        for subscribed_user_id, callback in list(self.subscribers.values()):
+            if subscribed_user_id == user_id:
+                self.notify(callback, snapshot)
+
+    def publish_many(self, snapshots):
+        for user_id, snapshot in snapshots.items():
+            self.publish(user_id, snapshot)
+
+    @staticmethod
+    def notify(callback, snapshot):
+        try:
+            callback(snapshot)
+        except Exception as e:
+            logger.error(f'snapshot subscriber failed for user {snapshot["user_id"]}: {e!r}')
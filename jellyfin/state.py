@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+
+from config import logger
+
+
+class StateSnapshot:
+    def __init__(self, file_name='config/state.json'):
+        self.file_name = file_name
+        self.name = file_name
+        self.saved = None
+
+    def load(self):
+        if not os.path.isfile(self.file_name):
+            return None
+        try:
+            with open(self.file_name, 'r') as file:
+                self.saved = file.read()
+            return json.loads(self.saved)
+        except (OSError, ValueError) as e:
+            logger.warning(f'state snapshot {self.file_name} not loaded: {e}')
+            return None
+
+    def save(self, state):
+        text = json.dumps(state, sort_keys=True)
+        if text == self.saved:
+            return
+        # a temp file of its own for every save, no other thread or process writes or moves it
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(self.file_name) or '.',
+                                        prefix=f'{os.path.basename(self.file_name)}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(text)
+            os.replace(tmp_name, self.file_name)  # atomic, a crash never leaves a partial snapshot
+        except OSError:
+            os.remove(tmp_name)
+            raise
+        self.saved = text
+
+
+# the same snapshot kept in a shared state backend, so processes sharing it do not overwrite each other's files
+class BackendSnapshot:
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+        self.name = f'shared state {key}'
+        self.saved = None
+
+    def load(self):
+        state = self.backend.get(self.key)
+        self.saved = json.dumps(state, sort_keys=True) if state else None
+        return state
+
+    def save(self, state):
+        text = json.dumps(state, sort_keys=True)
+        if text == self.saved:
+            return
+        self.backend.set(self.key, state)
+        self.saved = text
@@ -1,9 +1,13 @@
 import json
+import sqlite3
+import threading
+import time
 from abc import abstractmethod
+from datetime import datetime, timedelta
 
-import requests
-
-from misc import get_hours_of_today
+from config import logger
+from jellyfin.client import HttpClient, is_status
+from misc import clip, get_hours_of_today
 
 
 class AggregatedStatsSource:
@@ -11,38 +15,248 @@ class AggregatedStatsSource:
     def get_total_time_sec(self, user_id, date_start, date_end):
         pass
 
+    def get_total_time_sec_many(self, user_ids, date_start, date_end):
+        # users whose watch time could not be read are left out, they must not be taken as 0 watched
+        times = {user_id: self.get_total_time_sec(user_id, date_start, date_end) for user_id in user_ids}
+        return {user_id: time_sec for user_id, time_sec in times.items() if time_sec is not None}
+
+    def reset(self):
+        pass
+
+    @property
+    def name(self):
+        return type(self).__name__
+
 
 class PlaytimeReporting(AggregatedStatsSource):
-    def __init__(self, server, token):
+    def __init__(self, server, token, client: HttpClient = None, timeout=None):
         self.server = server
         self.token = token
         self.headers = {'Authorization': f'MediaBrowser Token={self.token}',
                         'Accept': 'application/json',
                         'Content-Type': 'application/json'}
         self.decoder = json.JSONDecoder()
+        self.client = client if client else HttpClient()
+        self.timeout = timeout
+
+    def submit_query(self, sql):
+        payload = {'CustomQueryString': sql}
+        r = self.client.post(f"{self.server}/user_usage_stats/submit_custom_query", headers=self.headers,
+                             data=json.dumps(payload), timeout=self.timeout, upstream='stats')
+        if is_status(r, 200):
+            return self.decoder.decode(r.text)["results"]
+        return None
 
     def get_total_time_sec(self, user_id, date_start, date_end):
         sql = f"SELECT SUM(PlayDuration) AS TotalTime FROM PlaybackActivity WHERE UserId='{user_id}'" \
               f" AND DateCreated > '{date_start}' AND DateCreated < '{date_end}'"
-        payload = {'CustomQueryString': sql}
-        r = requests.post(f"{self.server}/user_usage_stats/submit_custom_query", headers=self.headers,
-                          data=json.dumps(payload))
+        results = self.submit_query(sql)
+        if results is None:
+            return None
         time_sec = 0
-        if r.status_code == 200:
-            result_text = self.decoder.decode(r.text)["results"][0][0]
+        if results:
+            result_text = results[0][0]
             if result_text:
                 time_sec = int(result_text)
         return time_sec
 
+    def get_total_time_sec_many(self, user_ids, date_start, date_end):
+        times = {user_id: 0 for user_id in user_ids}
+        if not times:
+            return times
+        users = ", ".join(f"'{x}'" for x in times)
+        sql = f"SELECT UserId, SUM(PlayDuration) AS TotalTime FROM PlaybackActivity WHERE UserId IN ({users})" \
+              f" AND DateCreated > '{date_start}' AND DateCreated < '{date_end}' GROUP BY UserId"
+        results = self.submit_query(sql)
+        if results is None:
+            return {}
+        for user_id, result_text in results:
+            if user_id in times and result_text:
+                times[user_id] = int(result_text)
+        return times
+
+    def get_activity_rows(self, user_ids, after_rowid, date_start, date_end):
+        # rows are scanned by rowid (the table's primary key), the extra row reports the table's highest rowid
+        users = ", ".join(f"'{x}'" for x in user_ids)
+        sql = f"SELECT rowid, UserId, DateCreated, PlayDuration FROM PlaybackActivity WHERE rowid > {after_rowid}" \
+              f" AND UserId IN ({users}) AND DateCreated > '{date_start}' AND DateCreated < '{date_end}'" \
+              f" UNION ALL SELECT MAX(rowid), NULL, NULL, 0 FROM PlaybackActivity"
+        results = self.submit_query(sql)
+        if results is None:
+            return None
+        rows = []
+        max_rowid = 0
+        for rowid, user_id, date_created, duration in results:
+            if not user_id:  # the plugin may report NULL as an empty string
+                max_rowid = int(rowid) if rowid else 0
+            else:
+                rows.append((int(rowid), user_id, date_created, int(duration) if duration else 0))
+        return sorted(rows), max_rowid
+
+
+class IncrementalStats(AggregatedStatsSource):
+    # keeps running daily totals and reads only activity rows added since the last poll;
+    # rows younger than settle_hours are re-read on every poll, as their duration may still be updated
+    def __init__(self, source: PlaytimeReporting, settle_hours=6):
+        self.source = source
+        self.settle_hours = settle_hours
+        self.lock = threading.Lock()
+        self.day = None
+        self.first_rowid = 0  # no row of the current day is below it
+        self.settled_sec = {}
+        self.settled_rowid = 0
+        self.max_rowid = 0
+        self.totals = {}
+        self.reset_pending = False
+
+    def reset(self):
+        self.reset_pending = True  # applied by the next query, not to wait here for one running
+
+    def start_day(self, day, first_rowid=0):
+        self.day = day
+        self.first_rowid = first_rowid
+        self.settled_sec = {}
+        self.settled_rowid = first_rowid
+        self.max_rowid = first_rowid
+        self.totals = {}
+
+    def get_total_time_sec(self, user_id, date_start, date_end):
+        return self.get_total_time_sec_many([user_id], date_start, date_end).get(user_id)
+
+    def get_total_time_sec_many(self, user_ids, date_start, date_end):
+        user_ids = list(user_ids)
+        day = (date_start, date_end)
+        with self.lock:
+            if self.reset_pending:
+                self.reset_pending = False
+                self.day = None
+            if self.day != day:
+                # rows of a new day are all added after the last poll of the previous one, a cold start reads all
+                self.start_day(day, self.max_rowid)
+            elif any(x not in self.settled_sec for x in user_ids):
+                self.start_day(day, self.first_rowid)  # re-sync of the day for a new user
+            users = list(dict.fromkeys(list(self.settled_sec) + user_ids))
+            result = self.source.get_activity_rows(users, self.settled_rowid, date_start, date_end)
+            if result is not None and result[1] < self.max_rowid:
+                logger.warning('playback activity rows were removed, re-syncing watch time')
+                self.start_day(day)
+                result = self.source.get_activity_rows(users, 0, date_start, date_end)
+            if result is None:
+                if not self.totals:  # never synced, fall back to the plain aggregated query
+                    self.day = None
+                    return self.source.get_total_time_sec_many(user_ids, date_start, date_end)
+                return {x: self.totals.get(x, 0) for x in user_ids}
+            self.apply_rows(users, *result)
+            return {x: self.totals.get(x, 0) for x in user_ids}
+
+    def apply_rows(self, user_ids, rows, max_rowid):
+        settle_time = (datetime.now() - timedelta(hours=self.settle_hours)).strftime('%Y-%m-%d %H:%M:%S')
+        for user_id in user_ids:
+            self.settled_sec.setdefault(user_id, 0)
+        totals = dict(self.settled_sec)
+        settling = True
+        for rowid, user_id, date_created, duration in rows:
+            settling = settling and date_created < settle_time
+            if settling:
+                self.settled_sec[user_id] = self.settled_sec.get(user_id, 0) + duration
+                self.settled_rowid = rowid
+            totals[user_id] = totals.get(user_id, 0) + duration
+        # no unsettled row of these users lies below the first one read, the next poll starts there
+        self.settled_rowid = max(self.settled_rowid, rows[0][0] - 1 if rows else max_rowid)
+        self.max_rowid = max_rowid
+        self.totals = totals
+
+
+class LivePlaybackStats(AggregatedStatsSource):
+    # adds the progress of playbacks still running to the recorded totals, which get their duration
+    # only after an item stops; sessions of all users are read in a single request
+    def __init__(self, source: AggregatedStatsSource, get_sessions):
+        self.source = source
+        self.get_sessions = get_sessions
+        self.lock = threading.Lock()
+        self.playbacks = {}  # (session id, item id) -> user id, last seen time and position, counted seconds
+        self.read_time = None  # of the previous sessions read
+
+    @property
+    def name(self):
+        return self.source.name  # named after the source actually queried
+
+    def get_state(self):
+        with self.lock:
+            return {'read_time': self.read_time,
+                    'playbacks': [{'session_id': session_id, 'item_id': item_id, **playback}
+                                  for (session_id, item_id), playback in self.playbacks.items()]}
+
+    def set_state(self, state):
+        # playbacks of the previous run, still running ones keep what was counted before the restart
+        with self.lock:
+            self.read_time = state['read_time']
+            self.playbacks = {(x.pop('session_id'), x.pop('item_id')): x for x in map(dict, state['playbacks'])}
+
+    def reset(self):
+        self.source.reset()
+        with self.lock:
+            for playback in self.playbacks.values():
+                playback['live_sec'] = 0
+
+    def update_playbacks(self):
+        sessions = self.get_sessions()
+        if sessions is None:
+            return
+        now = time.time()
+        with self.lock:
+            # a playback seen for the first time started after the previous read at the earliest
+            unseen_sec = now - self.read_time if self.read_time else 0
+            playbacks = {}
+            for session in sessions:
+                item = session.get('NowPlayingItem')
+                if not item or not session.get('UserId'):
+                    continue
+                key = (session['Id'], item['Id'])
+                play_state = session.get('PlayState', {})
+                ticks = play_state.get('PositionTicks')
+                position_sec = ticks / 10 ** 7 if ticks is not None else None
+                playback = self.playbacks.get(key)
+                if playback is None:
+                    playback = {'user_id': session['UserId'], 'live_sec': min(position_sec or 0, unseen_sec)}
+                elif not play_state.get('IsPaused'):
+                    elapsed_sec = now - playback['seen']
+                    if position_sec is not None and playback['position_sec'] is not None:
+                        # no more than the position moved, e.g. while paused with the app down
+                        elapsed_sec = clip(position_sec - playback['position_sec'], 0, elapsed_sec)
+                    playback['live_sec'] += elapsed_sec
+                playback['seen'] = now
+                playback['position_sec'] = position_sec
+                playbacks[key] = playback
+            self.playbacks = playbacks
+            self.read_time = now
+
+    def get_live_time_sec(self, user_id):
+        with self.lock:
+            return sum(x['live_sec'] for x in self.playbacks.values() if x['user_id'] == user_id)
+
+    def get_total_time_sec(self, user_id, date_start, date_end):
+        self.update_playbacks()
+        time_sec = self.source.get_total_time_sec(user_id, date_start, date_end)
+        return None if time_sec is None else time_sec + int(self.get_live_time_sec(user_id))
+
+    def get_total_time_sec_many(self, user_ids, date_start, date_end):
+        self.update_playbacks()
+        times = self.source.get_total_time_sec_many(user_ids, date_start, date_end)
+        return {user_id: time_sec + int(self.get_live_time_sec(user_id)) for user_id, time_sec in times.items()}
+
 
 class JellyStats(AggregatedStatsSource):
-    def __init__(self, server, token):
+    def __init__(self, server, token, client: HttpClient = None, timeout=None):
         self.server = server
         self.token = token
         self.headers = {'accept': 'application/json',
                         'content-Type': 'application/json',
                         'x-api-token': f'{self.token}'}
         self.decoder = json.JSONDecoder()
+        self.client = client if client else HttpClient()
+        self.timeout = timeout
+        self.paged_history = True
 
     def get_total_time_sec(self, user_id, date_start, date_end):
         hours = get_hours_of_today()
@@ -50,12 +264,121 @@ class JellyStats(AggregatedStatsSource):
             'hours': f'{hours}',
             'userid': f'{user_id}'
         }
-        r = requests.post(f"{self.server}/stats/getGlobalUserStats", headers=self.headers, data=json.dumps(payload))
+        r = self.client.post(f"{self.server}/stats/getGlobalUserStats", headers=self.headers,
+                             data=json.dumps(payload), timeout=self.timeout, upstream='stats')
+        if not is_status(r, 200):
+            return None
+        if not r.text:  # version 1.1.1 returns inconsistent results - empty string instead of reporting 0 plays
+            return 0
         time_sec = 0
-        if r.status_code == 200:
-            if not r.text:  # version 1.1.1 returns inconsistent results - empty string instead of reporting 0 plays
-                return 0
-            result_text = self.decoder.decode(r.text)["total_playback_duration"]
-            if result_text:
-                time_sec = int(result_text)
+        result_text = self.decoder.decode(r.text)["total_playback_duration"]
+        if result_text:
+            time_sec = int(result_text)
         return time_sec
+
+    def get_history_page(self, page, size):
+        # newest records first; tells whether older pages follow
+        params = {'page': page, 'size': size, 'sort': 'ActivityDateInserted', 'desc': 'true'}
+        r = self.client.get(f"{self.server}/api/getHistory", headers=self.headers, params=params,
+                            timeout=self.timeout, upstream='stats')
+        if not is_status(r, 200) or not r.text:
+            return None
+        result = self.decoder.decode(r.text)
+        if not isinstance(result, dict):  # versions without paging return the whole history, no use for a mirror
+            if self.paged_history:
+                logger.warning('Jellystat does not page its history, watch time is read per user')
+                self.paged_history = False
+            return None
+        return result.get('results') or [], page < (result.get('pages') or 0)
+
+
+def get_played_time(record):
+    played = datetime.fromisoformat(record['ActivityDateInserted'].replace('Z', '+00:00'))
+    return played.astimezone()  # local time, days begin at local midnight as everywhere else
+
+
+class JellyStatsMirror(AggregatedStatsSource):
+    # keeps Jellystat's playback history in a local index by user and day, so one incremental fetch of the newest
+    # records per poll serves the totals of all users; records younger than settle_hours are fetched again,
+    # as Jellystat may insert a playback only after it ends
+    def __init__(self, source: JellyStats, db_name='config/jellystat.db', settle_hours=6, page_size=100,
+                 max_pages=50):
+        self.source = source
+        self.settle_hours = settle_hours
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_name, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS plays (id TEXT PRIMARY KEY, user_id TEXT NOT NULL,'
+                        ' day TEXT NOT NULL, duration INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS plays_by_user_day ON plays (user_id, day)')
+        self.day = None
+        self.synced_until = None  # time of the newest record mirrored
+        self.reset_pending = False
+
+    def reset(self):
+        self.reset_pending = True  # applied by the next query, not to wait here for one running
+
+    def start_day(self, date_start):
+        self.day = date_start
+        self.synced_until = None
+        with self.db:
+            self.db.execute('DELETE FROM plays WHERE day < ?', (date_start,))
+
+    def sync(self, date_start):
+        day_start = datetime.fromisoformat(date_start).astimezone()
+        cutoff = day_start
+        if self.synced_until:
+            cutoff = max(cutoff, self.synced_until - timedelta(hours=self.settle_hours))
+        newest = self.synced_until
+        if not self.source.paged_history:
+            return False
+        for page in range(1, self.max_pages + 1):
+            result = self.source.get_history_page(page, self.page_size)
+            if result is None:
+                return False
+            records, more = result
+            rows = []
+            for record in records:
+                if get_played_time(record) < cutoff:
+                    more = False  # the rest is older still
+                    break
+                for play in record.get('results') or [record]:  # grouped records list their playbacks
+                    played = get_played_time(play)
+                    if played < cutoff:
+                        continue
+                    rows.append((play['Id'], play['UserId'], played.strftime('%Y-%m-%d'),
+                                 int(float(play.get('PlaybackDuration') or 0))))
+                    newest = played if newest is None else max(newest, played)
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO plays (id, user_id, day, duration) VALUES (?, ?, ?, ?)',
+                                    rows)
+            if not more:
+                break
+        else:
+            logger.warning(f'Jellystat history not mirrored beyond {self.max_pages} pages')
+        self.synced_until = newest if newest else day_start
+        return True
+
+    def get_total_time_sec(self, user_id, date_start, date_end):
+        return self.get_total_time_sec_many([user_id], date_start, date_end).get(user_id)
+
+    def get_total_time_sec_many(self, user_ids, date_start, date_end):
+        times = {user_id: 0 for user_id in user_ids}
+        with self.lock:
+            if self.reset_pending:
+                self.reset_pending = False
+                self.synced_until = None
+            if self.day != date_start:
+                self.start_day(date_start)
+            if not self.sync(date_start) and self.synced_until is None:
+                # never mirrored today, fall back to the totals of each user
+                return self.source.get_total_time_sec_many(user_ids, date_start, date_end)
+            users = ', '.join('?' for _ in times)
+            rows = self.db.execute(f'SELECT user_id, SUM(duration) FROM plays WHERE user_id IN ({users})'
+                                   f' AND day >= ? AND day < ? GROUP BY user_id',
+                                   (*times, date_start, date_end)).fetchall()
+        for user_id, time_sec in rows:
+            times[user_id] = time_sec
+        return times
@@ -0,0 +1,64 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+from config import logger
+
+
+# merges webhook bursts: triggers arriving within the window share one job,
+# and a trigger of all users absorbs the pending triggers of single users
+class TriggerQueue:
+    def __init__(self, run_users, run_all, window_sec=2, history=100, ids=None):
+        self.run_users = run_users
+        self.run_all = run_all
+        self.window_sec = window_sec
+        self.history = history
+        self.ids = ids if ids else itertools.count(1)  # queues of several servers may share one sequence
+        self.jobs = OrderedDict()
+        self.pending = None
+        self.running = asyncio.Lock()
+        self.tasks = set()  # the event loop keeps only weak references to tasks
+
+    def submit(self, user_id=None):
+        job = self.pending
+        if job is None:
+            job = {'id': next(self.ids), 'status': 'queued', 'all': False, 'users': [], 'triggers': 0,
+                   'queued': time.time()}
+            self.pending = job
+            self.keep(job)
+            task = asyncio.create_task(self.run_later(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        job['triggers'] += 1
+        if user_id is None:
+            job['all'] = True
+            job['users'] = []
+        elif not job['all'] and user_id not in job['users']:
+            job['users'].append(user_id)
+        return job
+
+    def keep(self, job):
+        self.jobs[job['id']] = job
+        while len(self.jobs) > self.history:
+            self.jobs.popitem(last=False)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def run_later(self, job):
+        await asyncio.sleep(self.window_sec)
+        async with self.running:  # jobs never overlap; triggers arriving meanwhile gather in the next job
+            if self.pending is job:
+                self.pending = None
+            job['status'] = 'running'
+            logger.debug(f'trigger job {job["id"]} merged {job["triggers"]} triggers')
+            try:
+                if job['all']:
+                    await self.run_all()
+                else:
+                    await self.run_users(job['users'])
+                job['status'] = 'done'
+            except Exception as e:
+                logger.error(f'trigger job {job["id"]} failed: {e!r}')
+                job['status'] = 'failed'
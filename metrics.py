@@ -0,0 +1,105 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ID_SEGMENT = re.compile(r'^([0-9a-fA-F]{32}|[0-9a-fA-F-]{36}|\d+)$')
+
+
+def get_endpoint(url):
+    path = urlsplit(url).path
+    return '/'.join('{id}' if ID_SEGMENT.match(x) else x for x in path.split('/'))
+
+
+def get_key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    values = ','.join(f'{k}="{v}"' for k, v in labels)
+    return '{' + values + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[get_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    self.render_header(lines, name, kind)
+                    for (key_name, labels), value in sorted(values.items()):
+                        if key_name == name:
+                            lines.append(f'{name}{format_labels(labels)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                self.render_header(lines, name, 'histogram')
+                for (key_name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {bucket}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                    lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def render_header(self, lines, name, kind):
+        if name in self.help:
+            lines.append(f'# HELP {name} {self.help[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+
+metrics = Metrics()
+metrics.describe('watchwise_upstream_requests_total', 'Requests sent to Jellyfin and stats servers.')
+metrics.describe('watchwise_upstream_errors_total', 'Upstream requests that failed or returned an error status.')
+metrics.describe('watchwise_upstream_request_seconds', 'Latency of upstream requests.')
+metrics.describe('watchwise_stats_query_seconds', 'Time of reading watch time of a batch of users.')
+metrics.describe('watchwise_poll_cycles_total', 'Finished poll cycles.')
+metrics.describe('watchwise_poll_cycle_seconds', 'Duration of poll cycles.')
+metrics.describe('watchwise_poll_cycles_in_flight', 'Poll cycles running at the moment.')
+metrics.describe('watchwise_poll_cycle_overlaps_total', 'Poll cycles that waited for a running one to finish.')
+metrics.describe('watchwise_poll_cycles_skipped_total', 'Poll cycles skipped while another one was running.')
+metrics.describe('watchwise_poll_users_shed_total', 'Users left for the next cycle, as the cycle ran out of time.')
+metrics.describe('watchwise_upstream_short_circuits_total', 'Requests refused, as the upstream circuit was open.')
+metrics.describe('watchwise_upstream_circuit_open', 'Whether requests to the upstream are paused (1) or not (0).')
@@ -3,8 +3,8 @@ from datetime import datetime
 import i18n
 
 
-def setup_language(language_code):
-    i18n.load_path.append('lang')
+def setup_language(language_code, lang_dir='lang'):
+    i18n.load_path.append(lang_dir)
     i18n.set('file_format', 'json')
     i18n.set('filename_format', '{locale}.{format}')
     i18n.set('locale', language_code)
@@ -19,16 +19,5 @@ def get_today():
     return datetime.today().strftime('%Y-%m-%d')
 
 
-today = get_today()
-
-
-def has_new_day_begun():
-    global today
-    if today != get_today():
-        today = get_today()
-        return True
-    return False
-
-
 def get_hours_of_today():
     return int(datetime.today().strftime('%-H'))
@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+
+from fastapi.responses import PlainTextResponse
+
+from config import logger
+from jellyfin.async_interact import AsyncServerInteraction
+from jellyfin.backend import create_backend, get_owner
+from jellyfin.interact import ServerInteraction
+from jellyfin.scheduler import LockScheduler
+from jellyfin.state import BackendSnapshot, StateSnapshot
+from jellyfin.triggers import TriggerQueue
+from metrics import metrics
+
+
+# the enforcer of a single Jellyfin server: its users, polling and webhook triggers
+class ServerWorker:
+    def __init__(self, config, backend, job_ids=None):
+        self.config = config
+        self.name = config.name
+        self.backend = backend
+        if backend.shared:
+            snapshot = BackendSnapshot(backend, f'{config.name or "server"}/snapshot')
+        else:
+            snapshot = StateSnapshot(config.state_file)
+        self.interact = ServerInteraction(config, snapshot, backend)
+        self.engine = AsyncServerInteraction(self.interact, config.concurrency, config.slow_cycle_sec,
+                                             config.poll_budget_sec)
+        self.scheduler = LockScheduler.from_config(self.engine, config) if config.predictive_polling else None
+        self.triggers = TriggerQueue(self.refresh_users, self.refresh_all_users, config.trigger_window_sec,
+                                     ids=job_ids)
+        # of processes sharing the state backend, only the lease holder polls; the others serve views and webhooks
+        self.lease_name = self.interact.get_state_key('poll')
+        self.holds_lease = not backend.shared
+        if self.scheduler:
+            self.scheduler.enabled = self.holds_lease
+
+    async def refresh_users(self, user_ids):
+        watched = await self.engine.poll_users(user_ids)
+        if self.scheduler:
+            for user_id in user_ids:
+                self.scheduler.update(user_id, watched.get(user_id))
+
+    async def refresh_user(self, user_id):
+        await self.refresh_users([user_id])
+
+    async def refresh_all_users(self, skip_if_busy=False):
+        await self.engine.check_new_day()
+        await self.engine.poll_users(skip_if_busy=skip_if_busy)
+
+    async def poll_forever(self):
+        interval_sec = self.config.polling_interval * 60  # a changed interval takes effect after a restart
+        while True:
+            await asyncio.sleep(interval_sec)
+            try:
+                if self.holds_lease:
+                    await self.refresh_all_users(skip_if_busy=True)  # a slow server must not queue up cycles
+                else:
+                    await self.engine.refresh_subscribed()
+            except Exception as e:
+                logger.error(f'polling {self.name or "server"} failed: {e!r}')
+
+    async def keep_lease(self):
+        owner = get_owner()
+        while True:
+            try:
+                holds = await asyncio.to_thread(self.backend.acquire_lease, self.lease_name, owner,
+                                                self.config.lease_sec)
+            except Exception as e:
+                logger.error(f'poll lease not renewed: {e!r}')
+                holds = False
+            if holds != self.holds_lease:
+                logger.info(f'poll lease of {self.name or "server"} {"acquired" if holds else "lost"} by {owner}')
+                self.holds_lease = holds
+                if self.scheduler:
+                    self.scheduler.enabled = holds
+            await asyncio.sleep(self.config.lease_sec / 3)
+
+    async def apply_config(self, config):
+        self.config = config
+        await self.engine.run_io(self.interact.apply_config, config)
+        self.engine.slow_cycle_sec = config.slow_cycle_sec
+        self.engine.poll_budget_sec = config.poll_budget_sec
+        self.triggers.window_sec = config.trigger_window_sec
+        if self.scheduler:
+            self.scheduler.apply_config(config)
+        self.triggers.submit()  # new limits are applied without waiting for the next poll
+
+    def get_startup_tasks(self):
+        tasks = []
+        if self.interact.restored or not self.interact.users:  # no users when the server was down at startup
+            tasks.append(self.engine.refresh_server_state)
+        if self.backend.shared:
+            tasks.append(self.keep_lease)
+        if self.scheduler:
+            tasks.append(self.scheduler.run)
+        elif self.config.polling_interval > 0:
+            tasks.append(self.poll_forever)
+        return tasks
+
+
+# all configured servers, each one polled by its own worker, plus the config watcher and the HTTP routes
+# shared by the GUI and the headless mode
+class WatchWiseService:
+    def __init__(self, config):
+        self.config = config
+        job_ids = itertools.count(1)
+        self.backend = create_backend(config)
+        self.workers = [ServerWorker(server_config, self.backend, job_ids) for server_config in config.servers]
+
+    def get_worker(self, user_id):
+        for worker in self.workers:
+            if user_id in worker.interact.select_users:
+                return worker
+        return None
+
+    def get_select_users(self):
+        if len(self.workers) == 1:
+            return dict(self.workers[0].interact.select_users)
+        return {user_id: f'{worker.name} · {name}'
+                for worker in self.workers for user_id, name in worker.interact.select_users.items()}
+
+    @property
+    def default_user(self):
+        if self.get_worker(self.config.default_user):
+            return self.config.default_user
+        return next((x.config.default_user for x in self.workers if x.config.default_user), None)
+
+    async def subscribe(self, key, user_id, callback):
+        self.unsubscribe(key)
+        await self.get_worker(user_id).engine.subscribe(key, user_id, callback)
+
+    def unsubscribe(self, key):
+        for worker in self.workers:
+            worker.engine.unsubscribe(key)
+
+    async def watch_config(self):
+        mtime = self.config.get_mtime()
+        while True:
+            await asyncio.sleep(max(1, self.config.config_check_interval))
+            current_mtime = self.config.get_mtime()
+            if current_mtime == mtime:
+                continue
+            mtime = current_mtime
+            config = await asyncio.to_thread(self.config.reload)
+            if config:
+                await self.apply_config(config)
+
+    async def apply_config(self, config):
+        # every consumer reads the configuration through a single reference, so the swap is atomic
+        self.config = config
+        servers = {x.name: x for x in config.servers}
+        for worker in self.workers:
+            if worker.name in servers:
+                await worker.apply_config(servers[worker.name])
+        logger.info(f'configuration reloaded from {config.file_name}')
+
+    def get_startup_tasks(self):
+        tasks = [task for worker in self.workers for task in worker.get_startup_tasks()]
+        if self.config.config_check_interval > 0:
+            tasks.append(self.watch_config)
+        return tasks
+
+    def register_routes(self, app):
+        service = self
+
+        def job_status(job):
+            return {'job': job['id'], 'status': job['status']}
+
+        @app.get('/trigger/job/{job_id}')
+        def trigger_job(job_id: int):
+            for worker in service.workers:
+                job = worker.triggers.get(job_id)
+                if job:
+                    return job_status(job)
+            return {'job': job_id, 'status': 'unknown'}
+
+        @app.get('/trigger/{user_id}')
+        async def trigger_given_user(user_id):
+            logger.debug(f'trigger user with id {user_id}')
+            worker = service.get_worker(user_id)
+            if worker is None:
+                return {'name': 'unknown'}
+            worker.interact.invalidate_user(user_id)  # webhook may report a policy change made outside of this app
+            return {'name': worker.interact.select_users[user_id], **job_status(worker.triggers.submit(user_id))}
+
+        @app.get('/trigger')
+        async def trigger_all_users():
+            logger.debug('trigger all users')
+            if len(service.workers) == 1:
+                return job_status(service.workers[0].triggers.submit())
+            return {'jobs': [{'server': worker.name, **job_status(worker.triggers.submit())}
+                             for worker in service.workers]}
+
+        @app.get('/metrics')
+        def get_metrics():
+            return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')